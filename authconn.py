@@ -19,7 +19,19 @@
 ## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import cups
+import threading
+import time
 from debug import *
+import metrics
+import tracing
+
+log = get_logger ('authconn')
+
+# The password callback, user, server and port are process-wide
+# settings in pycups, so Connections on different threads (e.g. the
+# IPP worker threads of several servers) take turns: connecting and
+# each request, with its authentication passes, hold this lock.
+_lock = threading.RLock ()
 
 class AuthDialog():
     def __init__(self):
@@ -93,13 +105,19 @@ class AuthDialog(gtk.Dialog):
 """
 
 class Connection:
-    def __init__ (self, parent=None, try_as_root=True):
+    """A CUPS connection that retries requests with authentication.
+
+    Password callbacks are serialised between threads (see _lock).
+    Off the main thread, pass no parent and turn prompting off with
+    _set_prompt_allowed (False): no dialog can be shown there."""
+
+    def __init__ (self, parent=None, try_as_root=True, host=None, port=None):
         self._use_password = ''
         self._parent = parent
         self._try_as_root = try_as_root
         self._use_user = cups.getUser ()
-        self._server = cups.getServer ()
-        self._port = cups.getPort()
+        self._server = host or cups.getServer ()
+        self._port = port or cups.getPort()
         self._connect ()
         self._prompt_allowed = True
 
@@ -110,10 +128,18 @@ class Connection:
         self._prompt_allowed = allowed
 
     def _connect (self):
+        _lock.acquire ()
+        try:
+            self._connect_locked ()
+        finally:
+            _lock.release ()
+
+    def _connect_locked (self):
         cups.setUser (self._use_user)
         cups.setServer (self._server)
         cups.setPort (self._port)
         self._connection = cups.Connection ()
+        metrics.count ('authconn.connects')
         self._user = self._use_user
         debugprint ("Connected as user %s" % self._user)
         methodtype = type (self._connection.getPrinters)
@@ -129,6 +155,17 @@ class Connection:
         return lambda *args, **kwds: self._authloop (fname, fn, *args, **kwds)
 
     def _authloop (self, fname, fn, *args, **kwds):
+        start = time.time ()
+        span = tracing.begin ('authconn.' + fname, 'ipp')
+        _lock.acquire ()
+        try:
+            return self._run_authloop (fname, fn, *args, **kwds)
+        finally:
+            _lock.release ()
+            metrics.observe ('authconn.' + fname, time.time () - start)
+            tracing.end (span)
+
+    def _run_authloop (self, fname, fn, *args, **kwds):
         self._passes = 0
         c = self._connection
         while self._perform_authentication () != 0:
@@ -161,6 +198,7 @@ class Connection:
         return result
 
     def _failed (self, forbidden=False):
+        metrics.count ('authconn.auth-failures')
         self._has_failed = True
         self._forbidden = forbidden
 
@@ -176,7 +214,7 @@ class Connection:
     def _perform_authentication (self):
         self._passes += 1
 
-        debugprint ("Authentication pass: %d" % self._passes)
+        log.debug ("Authentication pass: %d", self._passes)
         if self._passes == 1:
             # Haven't yet tried the operation.  Set the password
             # callback and return > 0 so we try it for the first time.
@@ -185,13 +223,13 @@ class Connection:
             self._auth_called = False
             self._cancel = False
             cups.setPasswordCB (self._password_callback)
-            debugprint ("Authentication: password callback set")
+            log.debug ("Authentication: password callback set")
             return 1
 
         if not self._has_failed:
             # Tried the operation and it worked.  Return 0 to signal to
             # break out of the loop.
-            debugprint ("Authentication: Operation successful")
+            log.debug ("Authentication: Operation successful")
             return 0
 
         # Reset failure flag.
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""What debug logging costs the notification loop while debugging is
+switched off.
+
+Each case logs what handle_notifications logs for one event, the old
+way with debugprint and the new way with a debug.Logger.  Times are
+in nanoseconds per event, after subtracting the cost of the loop.
+
+Usage: python benchmarks/debuglog.py [iterations]"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert (0, os.path.join (os.path.dirname (__file__), os.pardir))
+
+ITERATIONS = 1000000
+
+SETUP = """
+import pprint
+from debug import debugprint, get_debugging, get_logger
+log = get_logger ('benchmark')
+seq = 1234
+nse = 'job-state-changed'
+event = { 'notify-subscribed-event': nse,
+          'notify-text': 'Job state changed.',
+          'notify-sequence-number': seq,
+          'notify-job-id': 42,
+          'job-state': 5,
+          'job-name': 'document.pdf',
+          'printer-name': 'queue',
+          'printer-state-reasons': ['none'] }
+class Monitor:
+    pass
+monitor = Monitor ()
+"""
+
+CASES = [
+    ("loop only", "pass"),
+
+    ("debugprint, format only",
+     "debugprint ('%d %s %s' % (seq, nse, event['notify-text']))"),
+
+    ("debugprint + get_debugging guard",
+     "debugprint ('%d %s %s' % (seq, nse, event['notify-text']))\n"
+     "if get_debugging ():\n"
+     "    debugprint (pprint.pformat (event))"),
+
+    ("debugprint with repr (Watcher)",
+     "debugprint (repr (monitor) + ': job %d added' % 42)"),
+
+    ("log.debug, lazy format",
+     "log.debug ('%d %s %s', seq, nse, event['notify-text'])"),
+
+    ("log.enabled () guard",
+     "if log.enabled ():\n"
+     "    log.debug ('%d %s %s', seq, nse, event['notify-text'])\n"
+     "    log.debug ('%s', pprint.pformat (event))"),
+
+    ("log.debugging guard",
+     "if log.debugging:\n"
+     "    log.debug ('%d %s %s', seq, nse, event['notify-text'])\n"
+     "    log.debug ('%s', pprint.pformat (event))"),
+
+    ("log.debug with %r (Watcher)",
+     "log.debug ('%r: job %d added', monitor, 42)"),
+    ]
+
+def main (argv):
+    iterations = ITERATIONS
+    if argv:
+        iterations = int (argv[0])
+
+    baseline = None
+    for (name, stmt) in CASES:
+        timer = timeit.Timer (stmt, SETUP)
+        seconds = min (timer.repeat (3, iterations))
+        ns = 1e9 * seconds / iterations
+        if baseline == None:
+            baseline = ns
+            continue
+
+        print "%-36s %8.1f" % (name, ns - baseline)
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""An in-process stand-in for a CUPS server, with the parts of the
+pycups Connection API that the Monitor uses.
+
+The server is driven from a script: add printers, submit jobs and
+change their states, set printer-state-reasons.  Each change queues
+events, with sequence numbers, for the subscriptions that asked for
+them, just as cupsd would.  Hand a FakeConnection to monitor.Monitor
+with its connection argument.
+
+The cups module is still needed for its constants and exceptions."""
+
+import bisect
+import time
+
+import cups
+
+# cupsd's default MaxEvents: the number of events it keeps per
+# subscription.
+MAX_EVENTS = 100
+
+# cupsd's default lease, in seconds.
+DEFAULT_LEASE = 86400
+
+NOTIFY_GET_INTERVAL = 60
+
+class FakeServer:
+    def __init__ (self, user=None, hostname='localhost',
+                  max_events=MAX_EVENTS):
+        if user == None:
+            user = cups.getUser ()
+        self.user = user
+        self.hostname = hostname
+        self.max_events = max_events
+        self.printers = {}
+        self.jobs = {}
+        self.jobids = [] # sorted
+        self.next_jobid = 1
+        self.subscriptions = {}
+        self.next_sub_id = 1
+        self.requests = {} # method -> number of calls
+
+    ## Scripting
+    def printer_uri (self, name):
+        return "ipp://%s/printers/%s" % (self.hostname, name)
+
+    def add_printer (self, name, reasons=None):
+        if reasons == None:
+            reasons = ['none']
+        self.printers[name] = {
+            'printer-name': name,
+            'printer-state': cups.IPP_PRINTER_IDLE,
+            'printer-state-reasons': list (reasons),
+            'printer-uri-supported': self.printer_uri (name),
+            'printer-more-info': "http://%s:631/printers/%s" %
+                                 (self.hostname, name),
+            'printer-is-accepting-jobs': True,
+            'printer-state-message': '' }
+        self.printer_event ('printer-added', name, "Printer %s added." % name)
+
+    def delete_printer (self, name):
+        self.printer_event ('printer-deleted', name,
+                            "Printer %s deleted." % name)
+        del self.printers[name]
+
+    def set_printer_state_reasons (self, name, reasons):
+        self.printers[name]['printer-state-reasons'] = list (reasons)
+        self.printer_event ('printer-state-changed', name,
+                            "Printer %s state changed." % name)
+
+    def submit_job (self, printer, name=None, user=None, state=None):
+        """Queues a job and returns its ID."""
+        jobid = self.next_jobid
+        self.next_jobid += 1
+        if name == None:
+            name = "document-%d" % jobid
+        if user == None:
+            user = self.user
+        if state == None:
+            state = cups.IPP_JOB_PENDING
+
+        self.jobids.append (jobid)
+        self.jobs[jobid] = {
+            'job-id': jobid,
+            'job-name': name,
+            'job-state': state,
+            'job-originating-user-name': user,
+            'job-printer-uri': self.printer_uri (printer),
+            'job-k-octets': 1 + jobid % 1024,
+            'time-at-creation': int (time.time ()),
+            'job-hold-until': 'no-hold',
+            'job-preserved': False,
+            'job-priority': 50,
+            'job-uri': "ipp://%s/jobs/%d" % (self.hostname, jobid),
+            'job-state-reasons': ['none'] }
+        self.job_event ('job-created', jobid, "Job created.")
+        return jobid
+
+    def set_job_state (self, jobid, state, text=None):
+        job = self.jobs[jobid]
+        job['job-state'] = state
+        if state >= cups.IPP_JOB_CANCELED:
+            nse = 'job-completed'
+        elif state == cups.IPP_JOB_STOPPED:
+            nse = 'job-stopped'
+        else:
+            nse = 'job-state-changed'
+        if text == None:
+            text = "Job state changed."
+        self.job_event (nse, jobid, text)
+
+    def job_progress (self, jobid):
+        self.job_event ('job-progress', jobid, "Job printing.")
+
+    ## Events
+    def printer_event (self, nse, name, text):
+        printer = self.printers[name]
+        event = { 'notify-subscribed-event': nse,
+                  'notify-text': text,
+                  'notify-printer-uri': self.printer_uri (name),
+                  'notify-printer-up-time': int (time.time ()),
+                  'printer-name': name,
+                  'printer-state': printer['printer-state'],
+                  'printer-state-reasons': list (printer['printer-state-reasons']),
+                  'printer-is-accepting-jobs': printer['printer-is-accepting-jobs'] }
+        self.queue_event (event)
+
+    def job_event (self, nse, jobid, text):
+        job = self.jobs[jobid]
+        uri = job['job-printer-uri']
+        name = uri[uri.rfind ('/') + 1:]
+        printer = self.printers[name]
+        event = { 'notify-subscribed-event': nse,
+                  'notify-text': text,
+                  'notify-job-id': jobid,
+                  'notify-printer-uri': uri,
+                  'notify-printer-up-time': int (time.time ()),
+                  'job-state': job['job-state'],
+                  'job-name': job['job-name'],
+                  'job-state-reasons': list (job['job-state-reasons']),
+                  'printer-name': name,
+                  'printer-state': printer['printer-state'],
+                  'printer-state-reasons': list (printer['printer-state-reasons']),
+                  'printer-is-accepting-jobs': printer['printer-is-accepting-jobs'] }
+        self.queue_event (event)
+
+    def queue_event (self, event):
+        for sub_id, sub in self.subscriptions.iteritems ():
+            if event['notify-subscribed-event'] not in sub['events']:
+                continue
+            if sub['dest'] != None and sub['dest'] != event['printer-name']:
+                continue
+
+            seq = sub['next-seq']
+            sub['next-seq'] += 1
+            e = event.copy ()
+            e['notify-subscription-id'] = sub_id
+            e['notify-sequence-number'] = seq
+            sub['queue'].append (e)
+            if len (sub['queue']) > self.max_events:
+                del sub['queue'][0]
+
+    def count (self, method):
+        self.requests[method] = self.requests.get (method, 0) + 1
+
+class FakeConnection:
+    """Implements the pycups Connection methods against a
+    FakeServer."""
+
+    def __init__ (self, server):
+        self.server = server
+
+    def _filter (self, attrs, requested_attributes):
+        if requested_attributes == None:
+            return attrs.copy ()
+
+        result = {}
+        for name in requested_attributes:
+            if attrs.has_key (name):
+                result[name] = attrs[name]
+        return result
+
+    def _subscription (self, sub_id):
+        try:
+            return self.server.subscriptions[sub_id]
+        except KeyError:
+            raise cups.IPPError (cups.IPP_NOT_FOUND, "Subscription not found")
+
+    def getPrinters (self, requested_attributes=None):
+        self.server.count ('getPrinters')
+        result = {}
+        for name, printer in self.server.printers.iteritems ():
+            result[name] = self._filter (printer, requested_attributes)
+        return result
+
+    def getPrinterAttributes (self, name=None, uri=None,
+                              requested_attributes=None):
+        self.server.count ('getPrinterAttributes')
+        if name == None and uri != None:
+            name = uri[uri.rfind ('/') + 1:]
+        try:
+            printer = self.server.printers[name]
+        except KeyError:
+            raise cups.IPPError (cups.IPP_NOT_FOUND, "Printer not found")
+        return self._filter (printer, requested_attributes)
+
+    def getDests (self):
+        self.server.count ('getDests')
+        dests = {}
+        for name in self.server.printers.keys ():
+            dests[(name, None)] = None
+        return dests
+
+    def getJobs (self, which_jobs='not-completed', my_jobs=False, limit=-1,
+                 first_job_id=-1, requested_attributes=None):
+        self.server.count ('getJobs')
+        jobids = self.server.jobids
+        start = 0
+        if first_job_id != -1:
+            start = bisect.bisect_left (jobids, first_job_id)
+
+        result = {}
+        for jobid in jobids[start:]:
+            job = self.server.jobs[jobid]
+            completed = job['job-state'] >= cups.IPP_JOB_CANCELED
+            if which_jobs == 'not-completed' and completed:
+                continue
+            if which_jobs == 'completed' and not completed:
+                continue
+            if (my_jobs and
+                job['job-originating-user-name'] != cups.getUser ()):
+                continue
+
+            result[jobid] = self._filter (job, requested_attributes)
+            if limit != -1 and len (result) >= limit:
+                break
+
+        return result
+
+    def getJobAttributes (self, jobid, requested_attributes=None):
+        self.server.count ('getJobAttributes')
+        try:
+            job = self.server.jobs[jobid]
+        except KeyError:
+            raise cups.IPPError (cups.IPP_NOT_FOUND, "Job not found")
+        return self._filter (job, requested_attributes)
+
+    def cancelJob (self, jobid):
+        self.server.count ('cancelJob')
+        self.server.set_job_state (jobid, cups.IPP_JOB_CANCELED)
+
+    def setJobHoldUntil (self, jobid, hold):
+        self.server.count ('setJobHoldUntil')
+        job = self.server.jobs[jobid]
+        job['job-hold-until'] = hold
+        if hold == 'no-hold':
+            state = cups.IPP_JOB_PENDING
+        else:
+            state = cups.IPP_JOB_HELD
+        self.server.set_job_state (jobid, state)
+
+    def restartJob (self, jobid):
+        self.server.count ('restartJob')
+        self.server.set_job_state (jobid, cups.IPP_JOB_PENDING)
+
+    def createSubscription (self, uri, events=[], job_id=-1,
+                            recipient_uri=None, lease_duration=-1,
+                            time_interval=-1, user_data=None):
+        self.server.count ('createSubscription')
+        dest = None
+        if uri != "/":
+            dest = uri[uri.rfind ('/') + 1:]
+            if not self.server.printers.has_key (dest):
+                raise cups.IPPError (cups.IPP_NOT_FOUND, "Printer not found")
+
+        sub_id = self.server.next_sub_id
+        self.server.next_sub_id += 1
+        if lease_duration == -1:
+            lease_duration = DEFAULT_LEASE
+        self.server.subscriptions[sub_id] = {
+            'events': set (events),
+            'uri': uri,
+            'dest': dest,
+            'lease': lease_duration,
+            'next-seq': 1,
+            'queue': [] }
+        return sub_id
+
+    def getSubscriptions (self, uri):
+        self.server.count ('getSubscriptions')
+        result = []
+        for sub_id, sub in self.server.subscriptions.iteritems ():
+            result.append ({ 'notify-subscription-id': sub_id,
+                             'notify-lease-duration': sub['lease'],
+                             'notify-events': list (sub['events']),
+                             'notify-subscriber-user-name': self.server.user })
+        return result
+
+    def renewSubscription (self, sub_id, lease_duration=-1):
+        self.server.count ('renewSubscription')
+        sub = self._subscription (sub_id)
+        if lease_duration == -1:
+            lease_duration = DEFAULT_LEASE
+        sub['lease'] = lease_duration
+
+    def cancelSubscription (self, sub_id):
+        self.server.count ('cancelSubscription')
+        self._subscription (sub_id)
+        del self.server.subscriptions[sub_id]
+
+    def getNotifications (self, subscription_ids, sequence_numbers=None):
+        self.server.count ('getNotifications')
+        events = []
+        for i in range (len (subscription_ids)):
+            sub = self._subscription (subscription_ids[i])
+            first = 0
+            if sequence_numbers != None:
+                first = sequence_numbers[i]
+
+            # As with cupsd, events stay queued until they drop off
+            # the end; the sequence numbers say which are new.
+            for event in sub['queue']:
+                if event['notify-sequence-number'] >= first:
+                    events.append (event.copy ())
+
+        return { 'events': events,
+                 'notify-get-interval': NOTIFY_GET_INTERVAL }
+
+    def close (self):
+        pass
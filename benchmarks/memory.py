@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Measures how much memory a job costs when kept as a raw pycups
+attribute dict and as a records.JobRecord.
+
+Usage: python benchmarks/memory.py [number of jobs ...]"""
+
+import gc
+import os
+import sys
+
+sys.path.insert (0, os.path.join (os.path.dirname (__file__), os.pardir))
+from records import JobRecord, JOB_FIELDS
+
+JOB_COUNTS = [10000, 100000]
+
+# What getJobAttributes typically gives us for a job, beyond the
+# attributes the applet uses.
+EXTRA_ATTRIBUTES = ['job-uri', 'job-more-info', 'job-priority',
+                    'job-sheets', 'job-media-sheets-completed',
+                    'job-state-reasons', 'job-printer-up-time',
+                    'job-printer-state-message', 'job-printer-state-reasons',
+                    'number-of-documents', 'number-of-intervening-jobs',
+                    'time-at-processing', 'time-at-completed',
+                    'document-format', 'copies', 'finishings',
+                    'job-billing', 'job-originating-host-name',
+                    'job-quota-period', 'job-k-limit', 'job-page-limit',
+                    'media', 'number-up', 'orientation-requested',
+                    'page-border', 'sides', 'outputorder', 'page-ranges']
+
+def make_job (jobid, full=False):
+    attrs = { 'job-id': jobid,
+              'job-state': 3,
+              'job-name': 'document-%d.pdf' % jobid,
+              'job-originating-user-name': 'user%d' % (jobid % 50),
+              'job-printer-uri': 'ipp://localhost/printers/queue%d' % (jobid % 20),
+              'job-k-octets': jobid % 4096,
+              'time-at-creation': 1230000000 + jobid,
+              'job-hold-until': 'no-hold',
+              'job-preserved': False }
+    if full:
+        for name in EXTRA_ATTRIBUTES:
+            attrs[name] = '%s-%d' % (name, jobid)
+    return attrs
+
+def rss (pid="self"):
+    """Resident set size in bytes of this process (or process pid),
+    or None if we can't tell."""
+    try:
+        f = open ("/proc/%s/statm" % pid)
+        pages = int (f.read ().split ()[1])
+        f.close ()
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf ('SC_PAGE_SIZE')
+
+def measure (n, build):
+    """Returns the bytes per job used by build (job attrs), counting
+    the container only (the values are the same either way) and as
+    resident memory."""
+    sources = [make_job (i, full=True) for i in xrange (1, n + 1)]
+    gc.collect ()
+    before = rss ()
+    jobs = {}
+    for attrs in sources:
+        jobs[attrs['job-id']] = build (attrs)
+    gc.collect ()
+    after = rss ()
+
+    container = 0
+    for job in jobs.itervalues ():
+        container += sys.getsizeof (job)
+        extra = getattr (job, '_extra', None)
+        if extra != None:
+            container += sys.getsizeof (extra)
+
+    if before == None or after == None:
+        resident = None
+    else:
+        resident = float (after - before) / n
+
+    return (float (container) / n, resident)
+
+def requested_dict (attrs):
+    # What getJobs (requested_attributes=...) returns.
+    job = {}
+    for name in JOB_FIELDS:
+        if attrs.has_key (name):
+            job[name] = attrs[name]
+    return job
+
+CASES = [("full attribute dict", dict),
+         ("requested attribute dict", requested_dict),
+         ("JobRecord", JobRecord.core)]
+
+def main (counts):
+    print "%-26s %10s %12s %14s" % ("representation", "jobs",
+                                     "bytes/job", "RSS bytes/job")
+    for n in counts:
+        for (name, build) in CASES:
+            (container, resident) = measure (n, build)
+            if resident == None:
+                resident = "n/a"
+            else:
+                resident = "%.0f" % resident
+            print "%-26s %10d %12.0f %14s" % (name, n, container, resident)
+
+if __name__ == '__main__':
+    counts = [int (arg) for arg in sys.argv[1:]] or JOB_COUNTS
+    main (counts)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Startup time and resident memory of printer-applet: as it starts
+at login, with its windows hidden (and not yet built); with --show,
+which builds them straight away as every start used to; and with
+--headless.
+
+Each run starts the applet from the source tree and times how long
+it takes to publish its services on the session bus, which it does
+once everything else is set up.  Its resident memory is read a little
+later, once the first job list has had time to arrive.  A KDE session
+(a display and a session bus) is needed, and a CUPS server unless
+the applet is told to --replay a recording.
+
+Usage: python benchmarks/startup.py [-n runs] [-- applet arguments]"""
+
+import dbus
+import getopt
+import os
+import subprocess
+import sys
+import time
+
+from memory import rss
+
+APPLET = os.path.join (os.path.dirname (os.path.abspath (__file__)),
+                       os.pardir, "printer-applet.py")
+BUS_NAME = "org.kde.PrinterApplet"
+RUNS = 5
+SETTLE = 2 # seconds to wait before reading resident memory
+TIMEOUT = 60 # seconds
+
+# With --show the bus name only appears once the windows are built,
+# so this mode includes what the default one leaves until later.
+MODES = [("gui", []),
+         ("gui --show", ["--show"]),
+         ("headless", ["--headless"])]
+
+def start_once (bus, extra_args):
+    """Starts the applet and waits for its services to appear.
+    Returns the time taken and the resident memory."""
+    if bus.name_has_owner (BUS_NAME):
+        raise RuntimeError, "%s is already running" % BUS_NAME
+
+    start = time.time ()
+    applet = subprocess.Popen ([sys.executable, APPLET] + extra_args,
+                               cwd=os.path.dirname (APPLET))
+    try:
+        while not bus.name_has_owner (BUS_NAME):
+            if applet.poll () != None:
+                raise RuntimeError, "applet exited (%d)" % applet.returncode
+            if time.time () - start > TIMEOUT:
+                raise RuntimeError, "applet did not start"
+            time.sleep (0.01)
+
+        elapsed = time.time () - start
+        time.sleep (SETTLE)
+        memory = rss (applet.pid)
+    finally:
+        if applet.poll () == None:
+            applet.terminate ()
+            applet.wait ()
+
+    return (elapsed, memory)
+
+def median (values):
+    values = sorted (values)
+    return values[len (values) / 2]
+
+def main (argv):
+    runs = RUNS
+    (opts, extra_args) = getopt.getopt (argv, "n:")
+    for (opt, value) in opts:
+        if opt == '-n':
+            runs = int (value)
+
+    bus = dbus.SessionBus ()
+    print "%-10s %10s %10s" % ("mode", "start (s)", "RSS (KiB)")
+    for (name, args) in MODES:
+        times = []
+        memory = []
+        for i in xrange (runs):
+            (elapsed, resident) = start_once (bus, args + extra_args)
+            times.append (elapsed)
+            if resident != None:
+                memory.append (resident / 1024)
+
+        if memory:
+            resident = "%d" % median (memory)
+        else:
+            resident = "n/a"
+        print "%-10s %10.2f %10s" % (name, median (times), resident)
+        sys.stdout.flush ()
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Monitor throughput against the fake CUPS server in fakecups.
+
+For each combination of job and printer counts this loads the queue,
+then feeds the Monitor batches of job state changes and printer state
+reason changes, and reports:
+
+  load       time to subscribe and fetch every job, in seconds
+  events/s   notification events handled per second
+  p50/p95    latency of one get_notifications batch, in milliseconds
+  KiB        resident memory the Monitor added for the loaded queue
+
+With -d, the Monitor only watches that many of the printers, as
+printer-applet does for specific destinations.  The events/s figure
+still counts every event the server generated.
+
+Usage: python benchmarks/throughput.py [-j jobs,...] [-p printers,...]
+                                       [-b batches] [-d dests]"""
+
+import gc
+import getopt
+import os
+import sys
+import time
+
+sys.path.insert (0, os.path.join (os.path.dirname (__file__), os.pardir))
+from PyQt4.QtCore import QCoreApplication
+import cups
+import monitor
+
+import fakecups
+from memory import rss
+
+JOB_COUNTS = [10, 1000, 100000]
+PRINTER_COUNTS = [10, 1000]
+BATCHES = 50
+LOAD_TIMEOUT = 600 # seconds
+
+class CountingWatcher(monitor.Watcher):
+    """A watcher that just counts the calls it gets, so that the
+    Monitor's own cost is what gets measured."""
+
+    def __init__ (self):
+        self.calls = 0
+
+    def _count (self, *args):
+        self.calls += 1
+
+    monitor_exited = _count
+    current_printers_and_jobs = _count
+    job_added = job_event = job_removed = _count
+    state_reason_added = state_reason_removed = _count
+    still_connecting = now_connected = _count
+    printer_added = printer_event = printer_removed = _count
+    cups_connection_error = cups_ipp_error = _count
+
+def make_server (n_jobs, n_printers):
+    server = fakecups.FakeServer ()
+    for i in xrange (n_printers):
+        reasons = ['none']
+        if i % 2:
+            # Plenty of printers carry a harmless-looking warning.
+            reasons = ['marker-supply-low-warning']
+        server.add_printer ("printer%d" % i, reasons)
+
+    for i in xrange (n_jobs):
+        server.submit_job ("printer%d" % (i % n_printers))
+
+    return server
+
+def load (app, server, n_jobs, dests=None):
+    """Starts a Monitor on server and waits for it to know about every
+    job it is watching.  Returns the Monitor and the time taken."""
+    if dests != None:
+        n_jobs = 0
+        for job in server.jobs.itervalues ():
+            uri = job['job-printer-uri']
+            if uri[uri.rfind ('/') + 1:] in dests:
+                n_jobs += 1
+
+    start = time.time ()
+    mon = monitor.Monitor (CountingWatcher (), bus=None, use_dbus=False,
+                           specific_dests=dests,
+                           connection=fakecups.FakeConnection (server))
+    while len (mon.jobs) < n_jobs:
+        app.processEvents ()
+        if time.time () - start > LOAD_TIMEOUT:
+            raise RuntimeError, "timed out loading %d jobs" % n_jobs
+
+    return (mon, time.time () - start)
+
+def feed_batch (server, batch, size):
+    """Queues size events: mostly job state changes, with a printer
+    state reason change every tenth event."""
+    jobids = server.jobids
+    printers = server.printers.keys ()
+    for i in xrange (size):
+        n = batch * size + i
+        if i % 10 == 9:
+            name = printers[n % len (printers)]
+            if n % 20 == 19:
+                reasons = ['media-empty-error']
+            else:
+                reasons = ['none']
+            server.set_printer_state_reasons (name, reasons)
+        else:
+            jobid = jobids[n % len (jobids)]
+            if server.jobs[jobid]['job-state'] == cups.IPP_JOB_PROCESSING:
+                state = cups.IPP_JOB_PENDING
+            else:
+                state = cups.IPP_JOB_PROCESSING
+            server.set_job_state (jobid, state)
+
+def percentile (values, p):
+    values = sorted (values)
+    i = min (len (values) - 1, int (len (values) * p))
+    return values[i]
+
+def run (app, n_jobs, n_printers, batches, n_dests=None):
+    server = make_server (n_jobs, n_printers)
+    dests = None
+    if n_dests != None:
+        dests = ["printer%d" % i for i in xrange (min (n_dests, n_printers))]
+    gc.collect ()
+    before = rss ()
+    (mon, load_time) = load (app, server, n_jobs, dests)
+    gc.collect ()
+    after = rss ()
+
+    size = server.max_events
+    latencies = []
+    for batch in xrange (batches):
+        feed_batch (server, batch, size)
+        start = time.time ()
+        mon.get_notifications ()
+        latencies.append (time.time () - start)
+
+    mon.cleanup ()
+    total = sum (latencies)
+    if total > 0:
+        rate = batches * size / total
+    else:
+        rate = 0
+
+    if before == None or after == None:
+        memory = "n/a"
+    else:
+        memory = "%d" % ((after - before) / 1024)
+
+    print "%8d %8d %8.2f %10.0f %8.2f %8.2f %8s" % (
+        n_jobs, n_printers, load_time, rate,
+        1000 * percentile (latencies, 0.5),
+        1000 * percentile (latencies, 0.95), memory)
+    sys.stdout.flush ()
+
+def main (argv):
+    job_counts = JOB_COUNTS
+    printer_counts = PRINTER_COUNTS
+    batches = BATCHES
+    n_dests = None
+    (opts, args) = getopt.getopt (argv, "j:p:b:d:")
+    for (opt, value) in opts:
+        if opt == '-j':
+            job_counts = [int (n) for n in value.split (',')]
+        elif opt == '-p':
+            printer_counts = [int (n) for n in value.split (',')]
+        elif opt == '-b':
+            batches = int (value)
+        elif opt == '-d':
+            n_dests = int (value)
+
+    app = QCoreApplication (sys.argv)
+    print "%8s %8s %8s %10s %8s %8s %8s" % ("jobs", "printers", "load",
+                                            "events/s", "p50", "p95", "KiB")
+    for n_printers in printer_counts:
+        for n_jobs in job_counts:
+            run (app, n_jobs, n_printers, batches, n_dests)
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
@@ -17,10 +17,27 @@
 ## along with this program; if not, write to the Free Software
 ## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import os
 import sys
 import traceback
 
+# Log levels.
+DEBUG=10
+INFO=20
+WARNING=30
+ERROR=40
+OFF=100
+
+_LEVEL_NAMES = { 'debug': DEBUG,
+                 'info': INFO,
+                 'warning': WARNING,
+                 'error': ERROR,
+                 'off': OFF }
+
 _debug=False
+_levels = {} # subsystem -> level set with set_log_level
+_loggers = {} # subsystem -> Logger
+
 def debugprint (x):
     if _debug:
         try:
@@ -34,22 +51,142 @@ def get_debugging ():
 def set_debugging (d):
     global _debug
     _debug = d
+    _update_loggers ()
+
+class lazy:
+    """Defers an expensive log argument, such as a pprint.pformat call,
+    until the message is actually going to be written.  Format it
+    with %s."""
+
+    def __init__ (self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__ (self):
+        return str (self.fn (*self.args))
+
+class Logger:
+    """Log messages for one subsystem.
+
+    The message is only formatted, with the % operator and the
+    remaining arguments, if the subsystem's level lets it through;
+    otherwise a call costs one comparison.  Guard anything dearer
+    than that with enabled (), or pass it in a lazy.  In the hottest
+    paths, test the debugging attribute instead: it is true when
+    debug messages are let through, and saves even the call."""
+
+    def __init__ (self, subsystem):
+        self.subsystem = subsystem
+        self.set_level (_level_for (subsystem))
+
+    def set_level (self, level):
+        self.level = level
+        self.debugging = DEBUG >= level
+
+    def enabled (self, level=DEBUG):
+        return level >= self.level
+
+    def log (self, level, msg, *args):
+        if level >= self.level:
+            self._emit (msg, args)
+
+    def debug (self, msg, *args):
+        if DEBUG >= self.level:
+            self._emit (msg, args)
+
+    def info (self, msg, *args):
+        if INFO >= self.level:
+            self._emit (msg, args)
+
+    def warning (self, msg, *args):
+        if WARNING >= self.level:
+            self._emit (msg, args)
+
+    def error (self, msg, *args):
+        if ERROR >= self.level:
+            self._emit (msg, args)
+
+    def _emit (self, msg, args):
+        try:
+            if args:
+                msg = msg % args
+            print "%s: %s" % (self.subsystem, msg)
+        except:
+            pass
+
+def get_logger (subsystem):
+    try:
+        return _loggers[subsystem]
+    except KeyError:
+        logger = Logger (subsystem)
+        _loggers[subsystem] = logger
+        return logger
+
+def _level_for (subsystem):
+    try:
+        return _levels[subsystem]
+    except KeyError:
+        pass
+
+    if _debug:
+        return DEBUG
+    return _levels.get (None, OFF)
+
+def _update_loggers ():
+    for logger in _loggers.itervalues ():
+        logger.set_level (_level_for (logger.subsystem))
+
+def set_log_level (subsystem, level):
+    """Sets the level for one subsystem, or with subsystem None for
+    every subsystem not given its own."""
+    _levels[subsystem] = level
+    _update_loggers ()
+
+def set_log_levels (spec):
+    """Sets levels from a string such as "monitor,authconn=info".
+    A subsystem named without a level gets DEBUG; "all" stands for
+    every subsystem."""
+    for item in spec.split (','):
+        item = item.strip ()
+        if not item:
+            continue
+        if item.find ('=') != -1:
+            (subsystem, name) = item.split ('=', 1)
+            try:
+                level = _LEVEL_NAMES[name.strip ().lower ()]
+            except KeyError:
+                print >> sys.stderr, "Unknown log level %s" % name
+                continue
+        else:
+            (subsystem, level) = (item, DEBUG)
+
+        subsystem = subsystem.strip ()
+        if subsystem == 'all':
+            subsystem = None
+        _levels[subsystem] = level
+
+    _update_loggers ()
+
+if os.environ.has_key ('PRINTER_APPLET_DEBUG'):
+    set_log_levels (os.environ['PRINTER_APPLET_DEBUG'])
 
 def fatalException (exitcode=1):
     nonfatalException (type="fatal", end="Exiting")
     sys.exit (exitcode)
 
+# Caught exceptions are always reported, whatever the levels.  This
+# logger is not in _loggers, so set_log_levels leaves it alone.
+_exception_log = Logger ('exception')
+_exception_log.set_level (DEBUG)
+
 def nonfatalException (type="non-fatal", end="Continuing anyway.."):
-    d = get_debugging ()
-    set_debugging (True)
-    debugprint ("Caught %s exception.  Traceback:" % type)
+    # This is called from the IPP worker threads too, so the
+    # traceback goes out as a single message.
+    lines = ["Caught %s exception.  Traceback:" % type]
     (type, value, tb) = sys.exc_info ()
-    tblast = traceback.extract_tb (tb, limit=None)
-    if len (tblast):
-        tblast = tblast[:len (tblast) - 1]
     extxt = traceback.format_exception_only (type, value)
     for line in traceback.format_tb(tb):
-        debugprint (line.strip ())
-    debugprint (extxt[0].strip ())
-    debugprint (end)
-    set_debugging (d)
+        lines.append (line.strip ())
+    lines.append (extxt[0].strip ())
+    lines.append (end)
+    _exception_log.error ("%s", "\n".join (lines))
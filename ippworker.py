@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+import Queue
+import sys
+
+from PyQt4.QtCore import *
+from debug import *
+
+class IPPWorker(QThread):
+    """Runs blocking IPP requests on a background thread so that a
+    slow or unreachable CUPS server can't freeze the GUI.
+
+    Requests run one at a time in the order they were submitted.
+    Results are passed back to the thread that created the worker
+    (the GUI thread) with a queued signal, so callbacks are free to
+    touch widgets and Monitor state.
+
+    libcups keeps the current user and server per thread, so the
+    cups.setUser calls made by requests don't affect other threads."""
+
+    def __init__ (self, parent=None):
+        QThread.__init__ (self, parent)
+        self.requests = Queue.Queue ()
+        self.connect (self, SIGNAL ("requestDone(PyQt_PyObject)"),
+                      self._dispatch, Qt.QueuedConnection)
+
+    def submit (self, fn, args=(), callback=None, errback=None):
+        """Calls fn (*args) on the worker thread, then callback with
+        the result on this one.  If fn raises an exception, errback
+        is called with the exception info instead."""
+        self.requests.put ((fn, args, callback, errback))
+        if not self.isRunning ():
+            self.start ()
+
+    def stop (self):
+        """Finishes the requests already submitted and then stops the
+        thread."""
+        if self.isRunning ():
+            self.requests.put (None)
+            self.wait ()
+
+    def run (self):
+        while True:
+            request = self.requests.get ()
+            if request == None:
+                break
+
+            (fn, args, callback, errback) = request
+            try:
+                result = fn (*args)
+                done = (callback, result)
+            except:
+                nonfatalException ()
+                done = (errback, sys.exc_info ())
+
+            self.emit (SIGNAL ("requestDone(PyQt_PyObject)"), done)
+
+    def _dispatch (self, done):
+        (fn, arg) = done
+        if fn != None:
+            fn (arg)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Counters and latency histograms describing what the applet is
+doing, kept in memory for anyone who asks.
+
+Metrics are updated from the main thread and the IPP worker threads
+alike.  The registry holds at most MAX_METRICS of them, however many
+different names turn up; updates to any more are counted in
+'metrics.dropped' and otherwise ignored.
+
+Names are dotted, e.g. 'ipp.getJobs'.  snapshot() flattens the lot
+into a dict of name to number: a counter is reported under its own
+name, and a histogram as name.count, name.sum (in seconds) and one
+name.le.<bound> per bucket, each holding the number of observations
+no greater than that many seconds."""
+
+import bisect
+import threading
+
+MAX_METRICS = 256
+
+# Histogram bucket upper bounds, in seconds.  Anything slower goes in
+# the last, unbounded bucket.
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                   0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+class Histogram:
+    def __init__ (self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len (bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe (self, value):
+        self.buckets[bisect.bisect_left (self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def flatten (self, name, result):
+        result[name + '.count'] = self.count
+        result[name + '.sum'] = self.sum
+        total = 0
+        for i in range (len (self.bounds)):
+            total += self.buckets[i]
+            result["%s.le.%g" % (name, self.bounds[i])] = total
+
+class Registry:
+    def __init__ (self, max_metrics=MAX_METRICS):
+        self.max_metrics = max_metrics
+        self.lock = threading.Lock ()
+        self.counters = {}
+        self.histograms = {}
+        self.dropped = 0
+
+    def _full (self):
+        return len (self.counters) + len (self.histograms) >= self.max_metrics
+
+    def count (self, name, n=1):
+        self.lock.acquire ()
+        try:
+            if self.counters.has_key (name):
+                self.counters[name] += n
+            elif self._full ():
+                self.dropped += 1
+            else:
+                self.counters[name] = n
+        finally:
+            self.lock.release ()
+
+    def observe (self, name, seconds):
+        self.lock.acquire ()
+        try:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                if self._full ():
+                    self.dropped += 1
+                    return
+                histogram = Histogram ()
+                self.histograms[name] = histogram
+
+            histogram.observe (seconds)
+        finally:
+            self.lock.release ()
+
+    def snapshot (self):
+        """Returns a dict of metric name to number."""
+        self.lock.acquire ()
+        try:
+            result = self.counters.copy ()
+            for name, histogram in self.histograms.iteritems ():
+                histogram.flatten (name, result)
+            result['metrics.dropped'] = self.dropped
+            return result
+        finally:
+            self.lock.release ()
+
+    def reset (self):
+        self.lock.acquire ()
+        try:
+            self.counters = {}
+            self.histograms = {}
+            self.dropped = 0
+        finally:
+            self.lock.release ()
+
+# The registry everything in the applet reports to.
+registry = Registry ()
+
+def count (name, n=1):
+    registry.count (name, n)
+
+def observe (name, seconds):
+    registry.observe (name, seconds)
+
+def snapshot ():
+    return registry.snapshot ()
@@ -18,12 +18,19 @@
 ## along with this program; if not, write to the Free Software
 ## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import bisect
 import cups
 import dbus
+import heapq
+import sys
 import time
 from debug import *
 import pprint
+import re
 from PyQt4.QtCore import *
+import ippworker
+import metrics
+import tracing
 
 #global _
 #_ = lambda x: x
@@ -31,29 +38,149 @@ from PyQt4.QtCore import *
 #    _ = x
 import statereason
 from statereason import StateReason
+from records import JobRecord, PrinterRecord
+
+log = get_logger ('monitor')
 #statereason.set_gettext_function (_)
 
 CONNECTING_TIMEOUT = 60 # seconds
 MIN_REFRESH_INTERVAL = 1 # seconds
-
-def state_reason_is_harmless (reason):
-    if (reason.startswith ("moving-to-paused") or
-        reason.startswith ("paused") or
-        reason.startswith ("shutdown") or
-        reason.startswith ("stopping") or
-        reason.startswith ("stopped-partly")):
-        return True
+JOB_BATCH_SIZE = 100 # job IDs spanned by one bulk attributes request
+JOB_PAGE_SIZE = 100 # jobs fetched per request when listing jobs
+SIGNAL_QUIET_INTERVAL = 200 # milliseconds
+SIGNAL_MAX_DELAY = 1000 # milliseconds
+SUBSCRIPTION_LEASE = 3600 # seconds asked for; the server may give less
+LEASE_RETRY_INTERVAL = 60 # seconds between failed renewals
+POLL_INTERVAL = 60 # seconds, until the server gives a notify-get-interval
+POLL_RETRY_INTERVAL = 5 # seconds before polling again after a failure
+POLL_RETRY_MAX = 300 # seconds; the retry interval doubles up to this
+
+# The job attributes the applet makes use of.
+JOB_ATTRIBUTES = ['job-id',
+                  'job-state',
+                  'job-name',
+                  'job-originating-user-name',
+                  'job-printer-uri',
+                  'job-k-octets',
+                  'time-at-creation',
+                  'job-hold-until',
+                  'job-preserved']
+
+def job_changed (old, new):
+    """Whether a job's state or name differs between two versions of
+    its attributes."""
+    for attribute in ['job-state', 'job-name']:
+        if old.get (attribute) != new.get (attribute):
+            return True
     return False
 
-def collect_printer_state_reasons (connection):
-    result = {}
+# printer-state-reasons that don't indicate a problem, matched as
+# prefixes.
+HARMLESS_STATE_REASON = re.compile ("moving-to-paused|paused|shutdown|"
+                                    "stopping|stopped-partly")
+harmless_state_reasons = {} # reason -> whether it is harmless
+HARMLESS_CACHE_SIZE = 1024 # reasons remembered before starting afresh
+
+def state_reason_is_harmless (reason):
     try:
+        return harmless_state_reasons[reason]
+    except KeyError:
+        harmless = HARMLESS_STATE_REASON.match (reason) != None
+        if len (harmless_state_reasons) >= HARMLESS_CACHE_SIZE:
+            # Printers can make up any number of reason strings.
+            harmless_state_reasons.clear ()
+        harmless_state_reasons[reason] = harmless
+        return harmless
+
+# The printer attributes the applet makes use of.
+PRINTER_ATTRIBUTES = ['printer-name',
+                      'printer-state',
+                      'printer-state-reasons',
+                      'printer-uri-supported',
+                      'printer-more-info']
+
+def fetch_printer_snapshot (connection):
+    """Fetches the printer list, asking only for the attributes we
+    use.  The result is shared by everything that needs to know about
+    printers during one refresh."""
+    try:
+        printers = connection.getPrinters (requested_attributes=PRINTER_ATTRIBUTES)
+    except TypeError:
+        # requested_attributes argument is not supported by this
+        # version of pycups.
         printers = connection.getPrinters ()
-    except cups.IPPError:
-        return result
 
+    snapshot = {}
+    for name, attrs in printers.iteritems ():
+        snapshot[name] = PrinterRecord.core (attrs)
+    return snapshot
+
+# Events about the set of queues, rather than about any one queue.
+SITE_EVENTS = ["printer-added", "printer-deleted"]
+
+def subscription_plan (events, specific_dests=None):
+    """Returns a list of (uri, events) subscriptions to create.
+
+    Without specific_dests that is a single subscription to "/".
+    Otherwise each destination gets its own subscription, so the
+    server only sends events for the queues we are watching, plus
+    one to "/" for the printer-added and printer-deleted events that
+    tell us when a watched queue comes or goes."""
+    if specific_dests == None:
+        return [("/", events)]
+
+    plan = []
+    site_events = [nse for nse in events if nse in SITE_EVENTS]
+    if site_events:
+        plan.append (("/", site_events))
+
+    dest_events = [nse for nse in events if nse not in SITE_EVENTS]
+    if dest_events:
+        dests = list (specific_dests)
+        dests.sort ()
+        for dest in dests:
+            plan.append (("/printers/%s" % dest, dest_events))
+
+    return plan
+
+def fetch_lease_duration (connection, sub_ids, requested):
+    """Returns the shortest notify-lease-duration the server actually
+    granted for a set of subscriptions.  If we can't find out, assume
+    it is the one we asked for."""
+    duration = None
+    try:
+        for sub in connection.getSubscriptions ("/"):
+            if sub.get ('notify-subscription-id') in sub_ids:
+                lease = sub.get ('notify-lease-duration', requested)
+                if duration == None or lease < duration:
+                    duration = lease
+    except (cups.IPPError, AttributeError):
+        # getSubscriptions is new in pycups 1.9.39.
+        pass
+
+    if duration == None:
+        return requested
+    return duration
+
+def merge_notifications (events):
+    """Puts events from several subscriptions back into the order they
+    happened in.  Each subscription's own events are already in
+    order, and the sort is stable."""
+    events.sort (key=lambda event: event.get ('notify-printer-up-time', 0))
+    return events
+
+def collect_printer_state_reasons (printers, specific_dests=None):
+    """Returns a dict of printer name to list of StateReasons for a
+    printer snapshot (see fetch_printer_snapshot).  With
+    specific_dests, only those printers are considered."""
+    result = {}
     for name, printer in printers.iteritems ():
-        reasons = printer["printer-state-reasons"]
+        if specific_dests != None and name not in specific_dests:
+            continue
+        reasons = printer.get ("printer-state-reasons", [])
+        if type (reasons) == str:
+            # Work around a bug that was fixed in pycups-1.9.20.
+            reasons = [reasons]
         for reason in reasons:
             if reason == "none":
                 break
@@ -64,53 +191,304 @@ def collect_printer_state_reasons (connection):
             result[name].append (StateReason (name, reason))
     return result
 
+def server_is_local (host):
+    """Whether host names the CUPS server on this machine, i.e. one
+    whose changes are announced on our system bus."""
+    return (host.startswith ('/') or
+            host in ['localhost', '127.0.0.1', '::1'])
+
+def parse_server (server):
+    """Splits a 'host[:port]' string into (host, port).  The port is
+    None if not given."""
+    if server.startswith ('/') or server.count (':') > 1:
+        # Domain socket, or bare IPv6 address.
+        return (server, None)
+
+    i = server.rfind (':')
+    if i == -1:
+        return (server, None)
+
+    try:
+        return (server[:i], int (server[i + 1:]))
+    except ValueError:
+        return (server, None)
+
+def printer_name_from_uri (uri):
+    i = uri.rfind ('/')
+    if i == -1:
+        return None
+    return uri[i + 1:]
+
+class PrinterJobIndex:
+    """Active jobs grouped by the printer they are queued on.
+
+    Rather than sorting the whole job list after every change, the
+    index is told which job IDs have changed and re-files just those."""
+
+    def __init__ (self):
+        self.printer_jobs = {} # printer -> {job ID: job}
+        self.job_printer = {} # job ID -> printer
+
+    def rebuild (self, jobs):
+        self.printer_jobs = {}
+        self.job_printer = {}
+        self.update (jobs, jobs.keys ())
+
+    def update (self, jobs, jobids):
+        """Re-files the given job IDs according to jobs.  A job ID
+        missing from jobs is dropped from the index.  Returns the set
+        of printers whose active jobs may have changed."""
+        printers = set()
+        for jobid in jobids:
+            printers.add (self._remove (jobid))
+            try:
+                data = jobs[jobid]
+            except KeyError:
+                continue
+
+            state = data.get ('job-state', cups.IPP_JOB_CANCELED)
+            if state >= cups.IPP_JOB_CANCELED:
+                continue
+            printer = printer_name_from_uri (data.get ('job-printer-uri', ''))
+            if printer == None:
+                continue
+
+            printers.add (printer)
+            self.job_printer[jobid] = printer
+            if not self.printer_jobs.has_key (printer):
+                self.printer_jobs[printer] = {}
+            self.printer_jobs[printer][jobid] = data
+
+        printers.discard (None)
+        return printers
+
+    def _remove (self, jobid):
+        try:
+            printer = self.job_printer.pop (jobid)
+        except KeyError:
+            return None
+
+        printer_jobs = self.printer_jobs[printer]
+        del printer_jobs[jobid]
+        if not printer_jobs:
+            del self.printer_jobs[printer]
+        return printer
+
+    def get_printers (self):
+        """Returns the set of printers with active jobs."""
+        return set (self.printer_jobs.keys ())
+
+    def get_jobs (self, printer):
+        return self.printer_jobs.get (printer, {}).copy ()
+
+    def has_processing_job (self, printer):
+        for data in self.printer_jobs.get (printer, {}).itervalues ():
+            if data.get ('job-state') == cups.IPP_JOB_PROCESSING:
+                return True
+        return False
+
+class MonitorConnection:
+    """A long-lived CUPS connection owned by a Monitor.
+
+    The underlying cups.Connection is created on first use and then
+    reused for every request.  If the server goes away (RuntimeError
+    or HTTPError) we reconnect once and, for requests in
+    RETRY_REQUESTS, retry the request.  Anything else may have reached
+    the server before the reply was lost, so retrying it could, for
+    instance, create a second subscription; those fail and the next
+    request reconnects."""
+
+    # Requests that only read, so are safe to make twice.
+    RETRY_REQUESTS = set (['getPrinters', 'getPrinterAttributes',
+                           'getDests', 'getJobs', 'getJobAttributes',
+                           'getSubscriptions', 'getNotifications'])
+
+    def __init__ (self, user, host, port, encryption):
+        self.user = user
+        self.host = host
+        self.port = port
+        self.encryption = encryption
+        self._connection = None
+
+    def __getattr__ (self, fname):
+        if fname[0] == '_':
+            raise AttributeError, fname
+        return lambda *args, **kwds: self._call (fname, *args, **kwds)
+
+    def _connect (self):
+        self._connection = cups.Connection (host=self.host,
+                                            port=self.port,
+                                            encryption=self.encryption)
+        log.debug ("Connected to %s:%d", self.host, self.port)
+
+    def _call (self, fname, *args, **kwds):
+        user = cups.getUser ()
+        start = time.time ()
+        span = tracing.begin ('ipp.' + fname, 'ipp')
+        try:
+            cups.setUser (self.user)
+            if self._connection == None:
+                self._connect ()
+            else:
+                metrics.count ('connection.reuses')
+
+            try:
+                return getattr (self._connection, fname) (*args, **kwds)
+            except (RuntimeError, cups.HTTPError):
+                # The server has probably closed the connection on
+                # us.  Try again once with a fresh one.
+                self._connection = None
+                if fname not in self.RETRY_REQUESTS:
+                    raise
+
+                log.debug ("%s failed; reconnecting", fname)
+                metrics.count ('connection.reconnects')
+                self._connect ()
+                return getattr (self._connection, fname) (*args, **kwds)
+        except:
+            metrics.count ('ipp.%s.errors' % fname)
+            raise
+        finally:
+            metrics.observe ('ipp.' + fname, time.time () - start)
+            tracing.end (span)
+            cups.setUser (user)
+
+    def close (self):
+        self._connection = None
+
+class NotificationScheduler:
+    """Decides when to fetch notifications.
+
+    request() is called for each D-Bus signal.  Signals that arrive
+    within quiet_interval of each other are collapsed into a single
+    fetch, which is put off by at most max_delay.  schedule() asks for
+    a fetch within a given time, e.g. for polling.  Only one fetch is
+    ever in flight: the fetch function must call finished() when it is
+    done, and anything requested meanwhile is handled after that."""
+
+    def __init__ (self, fetch, quiet_interval=SIGNAL_QUIET_INTERVAL,
+                  max_delay=SIGNAL_MAX_DELAY):
+        self.fetch = fetch
+        self.quiet_interval = quiet_interval
+        self.max_delay = max_delay
+        self.timer = QTimer ()
+        self.timer.setSingleShot (True)
+        QObject.connect (self.timer, SIGNAL ("timeout()"), self._fire)
+        self.in_flight = False
+        self.cycle_span = None
+        self.signal_due = None
+        self.poll_due = None
+        self.first_pending = None
+        self.pending = 0
+
+    def request (self):
+        now = time.time ()
+        metrics.count ('scheduler.signals')
+        self.pending += 1
+        if self.first_pending == None:
+            self.first_pending = now
+
+        self.signal_due = min (now + self.quiet_interval / 1000.0,
+                               self.first_pending + self.max_delay / 1000.0)
+        self._arm ()
+
+    def schedule (self, delay):
+        due = time.time () + delay / 1000.0
+        if self.poll_due == None or due < self.poll_due:
+            self.poll_due = due
+        self._arm ()
+
+    def finished (self):
+        self.in_flight = False
+        tracing.end (self.cycle_span)
+        self.cycle_span = None
+        if self.pending and self.signal_due == None:
+            self.signal_due = time.time () + self.quiet_interval / 1000.0
+        self._arm ()
+
+    def stop (self):
+        self.timer.stop ()
+        self.signal_due = None
+        self.poll_due = None
+
+    def _arm (self):
+        if self.in_flight:
+            # We'll be re-armed when the fetch finishes.
+            return
+
+        due = [t for t in [self.signal_due, self.poll_due] if t != None]
+        if not due:
+            self.timer.stop ()
+            return
+
+        delay = int ((min (due) - time.time ()) * 1000)
+        self.timer.start (max (0, delay))
+
+    def _fire (self):
+        if self.in_flight:
+            return
+
+        absorbed = self.pending
+        self.pending = 0
+        self.first_pending = None
+        self.signal_due = None
+        self.poll_due = None
+        metrics.count ('scheduler.fetches')
+        metrics.count ('scheduler.signals-absorbed', absorbed)
+        self.in_flight = True
+        log.debug ("Fetching notifications (%d signals absorbed)",
+                   absorbed)
+        self.cycle_span = tracing.begin ('get_notifications', 'cycle',
+                                         { 'absorbed': absorbed })
+        self.fetch ()
+
 class Watcher:
     # Interface definition
     def monitor_exited (self, monitor):
-        debugprint (repr (monitor) + " exited")
+        log.debug ("%r exited", monitor)
 
     def state_reason_added (self, monitor, reason):
-        debugprint (repr (monitor) + ": +" + repr (reason))
+        log.debug ("%r: +%r", monitor, reason)
 
     def state_reason_removed (self, monitor, reason):
-        debugprint (repr (monitor) + ": -" + repr (reason))
+        log.debug ("%r: -%r", monitor, reason)
 
     def still_connecting (self, monitor, reason):
-        debugprint (repr (monitor) + ": `%s' still connecting" %
-                    reason.get_printer ())
+        log.debug ("%r: `%s' still connecting", monitor, reason.printer)
 
     def now_connected (self, monitor, printer):
-        debugprint (repr (monitor) + ": `%s' now connected" % printer)
+        log.debug ("%r: `%s' now connected", monitor, printer)
 
     def current_printers_and_jobs (self, monitor, printers, jobs):
-        debugprint (repr (monitor) + ": printers and jobs lists provided")
+        log.debug ("%r: printers and jobs lists provided", monitor)
+
+    def jobs_fetched (self, monitor):
+        log.debug ("%r: job list fetched", monitor)
 
     def job_added (self, monitor, jobid, eventname, event, jobdata):
-        debugprint (repr (monitor) + ": job %d added" % jobid)
+        log.debug ("%r: job %d added", monitor, jobid)
 
     def job_event (self, monitor, jobid, eventname, event, jobdata):
-        debugprint (repr (monitor) + ": job %d has event `%s'" %
-                    (jobid, eventname))
+        log.debug ("%r: job %d has event `%s'", monitor, jobid, eventname)
 
     def job_removed (self, monitor, jobid, eventname, event):
-        debugprint (repr (monitor) + ": job %d removed" % jobid)
+        log.debug ("%r: job %d removed", monitor, jobid)
 
     def printer_added (self, monitor, printer):
-        debugprint (repr (monitor) + ": printer `%s' added" % printer)
+        log.debug ("%r: printer `%s' added", monitor, printer)
 
     def printer_event (self, monitor, printer, eventname, event):
-        debugprint (repr (monitor) + ": printer `%s' has event `%s'" %
-                    (printer, eventname))
+        log.debug ("%r: printer `%s' has event `%s'", monitor, printer,
+                   eventname)
 
     def printer_removed (self, monitor, printer):
-        debugprint (repr (monitor) + ": printer `%s' removed" % printer)
+        log.debug ("%r: printer `%s' removed", monitor, printer)
 
     def cups_connection_error (self, monitor):
-        debugprint (repr (monitor) + ": CUPS connection error")
+        log.debug ("%r: CUPS connection error", monitor)
 
     def cups_ipp_error (self, monitor, e, m):
-        debugprint (repr (monitor) + ": CUPS IPP error (%d, %s)" %
-                    (e, repr (m)))
+        log.debug ("%r: CUPS IPP error (%d, %r)", monitor, e, m)
 
 class Monitor:
     # Monitor jobs and printers.
@@ -118,68 +496,123 @@ class Monitor:
     DBUS_IFACE="com.redhat.PrinterSpooler"
 
     def __init__(self, watcher, bus=None, my_jobs=True, specific_dests=None,
-                 monitor_jobs=True, host=None, port=None, encryption=None):
+                 monitor_jobs=True, host=None, port=None, encryption=None,
+                 signal_quiet_interval=SIGNAL_QUIET_INTERVAL, worker=None,
+                 job_page_size=JOB_PAGE_SIZE, use_dbus=True,
+                 connection=None, record=None):
         self.watcher = watcher
+        self.worker = worker
         self.my_jobs = my_jobs
         self.specific_dests = specific_dests
         self.monitor_jobs = monitor_jobs
-        self.jobs = {}
+        self.jobs = {} # job ID -> JobRecord
+        self.jobs_shared = False
+        self.job_index = PrinterJobIndex ()
         self.printer_state_reasons = {}
         self.printers = set()
+        self.printer_snapshot = {}
         self.process_pending_events = True
-        self.fetch_jobs_timer = None
-
-        if host:
-            cups.setServer (host)
-        if port:
-            cups.setPort (port)
-        if encryption:
-            cups.setEncryption (encryption)
+        self.job_page_size = job_page_size
+        self.fetch_jobs_generation = 0
+        self.fetch_known_jobids = []
+        self.refreshing = False
+        self.refresh_again = False
+        self.refresh_span = None
+        self.lease_duration = None
+        self.lease_expires = None
+        self.lease_renewals = 0
+        self.lease_failures = 0
+        self.lease_timer = QTimer ()
+        self.lease_timer.setSingleShot (True)
+        QObject.connect (self.lease_timer, SIGNAL ("timeout()"),
+                         self.renew_lease)
+
+        # Don't use cups.setServer and friends: other Monitors in this
+        # process may be talking to different servers.
         self.user = cups.getUser ()
-        self.host = cups.getServer ()
-        self.port = cups.getPort ()
-        self.encryption = cups.getEncryption ()
+        self.host = host or cups.getServer ()
+        self.port = port or cups.getPort ()
+        if encryption == None:
+            encryption = cups.getEncryption ()
+        self.encryption = encryption
+        if connection == None:
+            connection = MonitorConnection (self.user, self.host,
+                                            self.port, self.encryption)
+        if record != None:
+            # Write every request and its answer to this file.
+            import recorder
+            connection = recorder.RecordingConnection (connection, record,
+                                                       host=self.host,
+                                                       port=self.port)
+        self.connection = connection
 
         self.which_jobs = "not-completed"
-        self.reasons_seen = {}
-        self.connecting_timers = {}
+        self.reasons_seen = {} # printer -> {reason tuple: StateReason}
+        self.connecting_printers = set()
+        self.connecting_deadlines = [] # heap of (time, printer)
+        self.connecting_timer = QTimer ()
+        self.connecting_timer.setSingleShot (True)
+        QObject.connect (self.connecting_timer, SIGNAL ("timeout()"),
+                         self.check_still_connecting)
         self.still_connecting = set()
         self.connecting_to_device = {}
         self.received_any_dbus_signals = False
+        self.poll_interval = POLL_INTERVAL
+        self.poll_failures = 0
         self.update_timer = None
+        self.scheduler = NotificationScheduler (self.scheduled_fetch,
+                                                signal_quiet_interval)
 
-        if bus == None:
+        # Only the local server signals its changes on our system bus.
+        # Others are polled.
+        self.bus = None
+        if use_dbus and bus == None:
             try:
                 bus = dbus.SystemBus ()
             except dbus.exceptions.DBusException:
                 # System bus not running.
                 pass
 
-        if bus != None:
+        if use_dbus and bus != None:
             bus.add_signal_receiver (self.handle_dbus_signal,
                                      path=self.DBUS_PATH,
                                      dbus_interface=self.DBUS_IFACE)
             self.bus = bus
 
-        self.sub_id = -1
+        self.sub_ids = []
+        self.sub_seqs = {} # subscription ID -> last sequence number seen
+        self.subscribed_dests = set()
         self.refresh ()
 
     def get_jobs (self):
-        return self.jobs.copy ()
+        """Returns a dict of job ID to JobRecord.  It must not be
+        modified."""
+        self.jobs_shared = True
+        return self.jobs
+
+    def writable_jobs (self):
+        """Returns the jobs dict for changing in place.  It is only
+        copied if get_jobs has handed it out since the last change."""
+        if self.jobs_shared:
+            self.jobs = self.jobs.copy ()
+            self.jobs_shared = False
+        return self.jobs
+
+    def get_printer_snapshot (self):
+        return self.printer_snapshot.copy ()
+
+    def get_server_name (self):
+        if self.host.startswith ('/'):
+            return 'localhost'
+        if self.port == cups.getPort ():
+            return self.host
+        return "%s:%d" % (self.host, self.port)
 
     def cleanup (self):
-        if self.sub_id != -1:
-            user = cups.getUser ()
-            try:
-                cups.setUser (self.user)
-                c = cups.Connection (host=self.host,
-                                     port=self.port,
-                                     encryption=self.encryption)
-                c.cancelSubscription (self.sub_id)
-                debugprint ("Canceled subscription %d" % self.sub_id)
-            except:
-                pass
-            cups.setUser (user)
+        self.scheduler.stop ()
+        self.connecting_timer.stop ()
+        self.lease_timer.stop ()
+        self.run_io (self.io_cleanup, (self.sub_ids,), None)
 
         if self.bus != None:
             self.bus.remove_signal_receiver (self.handle_dbus_signal,
@@ -188,171 +621,327 @@ class Monitor:
 
         self.watcher.monitor_exited (self)
 
+    def io_cleanup (self, sub_ids):
+        for sub_id in sub_ids:
+            try:
+                self.connection.cancelSubscription (sub_id)
+                log.debug ("Canceled subscription %d", sub_id)
+            except:
+                pass
+
+        self.connection.close ()
+
     def set_process_pending (self, whether):
         self.process_pending_events = whether
 
     def check_still_connecting(self):
-        """Timer callback to check on connecting-to-device reasons."""
-        #del self.connecting_timers[printer]
-        #debugprint ("Still-connecting timer fired for `%s'" % printer)
-        (printer_jobs, my_printers) = self.sort_jobs_by_printer ()
-        self.update_connecting_devices (printer_jobs)
+        """Timer callback to check on connecting-to-device reasons.
+        Only the printers whose deadlines have passed are looked at."""
+        time_now = time.time ()
+        due = set()
+        while (self.connecting_deadlines and
+               self.connecting_deadlines[0][0] <= time_now):
+            (deadline, printer) = heapq.heappop (self.connecting_deadlines)
+            log.debug ("Still-connecting deadline passed for `%s'", printer)
+            due.add (printer)
+
+        self.update_connecting_devices (due)
+        self.arm_connecting_timer ()
+
+    def add_connecting_deadline (self, printer, deadline):
+        heapq.heappush (self.connecting_deadlines, (deadline, printer))
+        if self.connecting_deadlines[0] == (deadline, printer):
+            self.arm_connecting_timer ()
+
+    def arm_connecting_timer (self):
+        """Sets the timer for the earliest connecting deadline."""
+        if not self.connecting_deadlines:
+            self.connecting_timer.stop ()
+            return
 
-        # Don't run this callback again.
-        return False
+        delay = self.connecting_deadlines[0][0] - time.time ()
+        self.connecting_timer.start (max (0, int (delay * 1000)))
 
-    def update_connecting_devices(self, printer_jobs={}):
-        """Updates connecting_to_device dict and still_connecting set."""
+    def update_connecting_devices(self, printers):
+        """Updates connecting_to_device dict and still_connecting set
+        for the given printers."""
         time_now = time.time ()
-        connecting_to_device = {}
-        trouble = False
-        for printer, reasons in self.printer_state_reasons.iteritems ():
-            connected = True
-            for reason in reasons:
-                if reason.get_reason () == "connecting-to-device":
-                    have_processing_job = False
-                    for job, data in \
-                            printer_jobs.get (printer, {}).iteritems ():
-                        state = data.get ('job-state',
-                                          cups.IPP_JOB_CANCELED)
-                        if state == cups.IPP_JOB_PROCESSING:
-                            have_processing_job = True
-                            break
+        for printer in printers:
+            reason = None
+            if printer in self.connecting_printers:
+                for r in self.printer_state_reasons.get (printer, []):
+                    if r.get_reason () == "connecting-to-device":
+                        reason = r
+                        break
+
+            if (reason != None and
+                not self.job_index.has_processing_job (printer)):
+                log.debug ("Ignoring stale connecting-to-device x")
+                reason = None
+
+            if reason == None:
+                # Clear any previously-notified error that is now fine.
+                if self.connecting_to_device.has_key (printer):
+                    del self.connecting_to_device[printer]
+                if printer in self.still_connecting:
+                    self.still_connecting.remove (printer)
+                    self.watcher.now_connected (self, printer)
+                continue
 
-                    if not have_processing_job:
-                        debugprint ("Ignoring stale connecting-to-device x")
-                        continue
-
-                    # Build a new connecting_to_device dict.  If our existing
-                    # dict already has an entry for this printer, use that.
-                    printer = reason.get_printer ()
-                    t = self.connecting_to_device.get (printer, time_now)
-                    connecting_to_device[printer] = t
-                    debugprint ("Connecting time: %d" % (time_now - t))
-                    if time_now - t >= CONNECTING_TIMEOUT:
-                        if have_processing_job:
-                            self.still_connecting.add (printer)
-                            self.watcher.still_connecting (self, reason)
-
-                    connected = False
-                    break
-
-        # Clear any previously-notified errors that are now fine.
-        remove = set()
-        for printer in self.still_connecting:
-            if not connecting_to_device.has_key (printer):
-                remove.add (printer)
-                self.watcher.now_connected (self, printer)
-
-        self.still_connecting = self.still_connecting.difference (remove)
-        self.connecting_to_device = connecting_to_device
-
-    def check_state_reasons(self, my_printers=set(), printer_jobs={}):
+            # If we already have an entry for this printer, keep its
+            # time.
+            t = self.connecting_to_device.setdefault (printer, time_now)
+            log.debug ("Connecting time: %d", time_now - t)
+            if time_now - t >= CONNECTING_TIMEOUT:
+                self.still_connecting.add (printer)
+                self.watcher.still_connecting (self, reason)
+
+    def check_state_reasons(self, printers=None):
+        """Tells the watcher about state reasons that have appeared or
+        gone away on the given printers since we last looked.  Without
+        printers, every printer is checked."""
+        if printers == None:
+            printers = set (self.printer_state_reasons.keys ())
+            printers.update (self.reasons_seen.keys ())
+
+        span = tracing.begin ('check_state_reasons', 'monitor',
+                              { 'printers': len (printers) })
         # Look for any new reasons since we last checked.
-        old_reasons_seen_keys = self.reasons_seen.keys ()
-        reasons_now = set()
-        for printer, reasons in self.printer_state_reasons.iteritems ():
-            for reason in reasons:
+        removed = []
+        for printer in printers:
+            seen = self.reasons_seen.get (printer, {})
+            reasons_now = {}
+            self.connecting_printers.discard (printer)
+            for reason in self.printer_state_reasons.get (printer, []):
                 tuple = reason.get_tuple ()
-                printer = reason.get_printer ()
-                reasons_now.add (tuple)
-                if not self.reasons_seen.has_key (tuple):
+                if seen.has_key (tuple):
+                    reasons_now[tuple] = seen[tuple]
+                else:
                     # New reason.
                     self.watcher.state_reason_added (self, reason)
-                    self.reasons_seen[tuple] = reason
+                    reasons_now[tuple] = reason
+
+                if reason.get_reason () == "connecting-to-device":
+                    self.connecting_printers.add (printer)
 
                 if (reason.get_reason () == "connecting-to-device" and
                     not self.connecting_to_device.has_key (printer)):
                     # First time we've seen this.
-
-                    have_processing_job = False
-                    for job, data in \
-                            printer_jobs.get (printer, {}).iteritems ():
-                        state = data.get ('job-state',
-                                          cups.IPP_JOB_CANCELED)
-                        if state == cups.IPP_JOB_PROCESSING:
-                            have_processing_job = True
-                            break
-
-                    if have_processing_job:
-                        QTimer.singleShot((1 + CONNECTING_TIMEOUT) * 1000, self.check_still_connecting)
-                        debugprint ("Start connecting timer for `%s'" %
-                                    printer)
+                    if self.job_index.has_processing_job (printer):
+                        deadline = time.time () + 1 + CONNECTING_TIMEOUT
+                        self.add_connecting_deadline (printer, deadline)
+                        log.debug ("Start connecting timer for `%s'", printer)
                     else:
                         # Don't notify about this, as it must be stale.
-                        debugprint ("Ignoring stale connecting-to-device")
-                        if get_debugging ():
-                            debugprint (pprint.pformat (printer_jobs))
-
-        self.update_connecting_devices (printer_jobs)
-        items = self.reasons_seen.keys ()
-        for tuple in items:
-            if not tuple in reasons_now:
-                # Reason no longer present.
-                reason = self.reasons_seen[tuple]
-                del self.reasons_seen[tuple]
-                self.watcher.state_reason_removed (self, reason)
+                        log.debug ("Ignoring stale connecting-to-device")
+                        log.debug ("%s", lazy (pprint.pformat,
+                                               self.job_index.get_jobs (printer)))
+
+            for tuple, reason in seen.iteritems ():
+                if not reasons_now.has_key (tuple):
+                    # Reason no longer present.
+                    removed.append (reason)
+
+            if reasons_now:
+                self.reasons_seen[printer] = reasons_now
+            elif self.reasons_seen.has_key (printer):
+                del self.reasons_seen[printer]
+
+        self.update_connecting_devices (printers)
+        for reason in removed:
+            self.watcher.state_reason_removed (self, reason)
+        tracing.end (span)
+
+    def run_io (self, fn, args, callback, errback=None):
+        """Runs fn (*args), which may block on IPP requests, and then
+        passes its result to callback.  With a worker the request is
+        made on the worker's thread and callback is called later from
+        the main loop; otherwise everything happens now."""
+        if self.worker != None:
+            self.worker.submit (fn, args, callback, errback)
+            return
+
+        if errback == None:
+            result = fn (*args)
+        else:
+            try:
+                result = fn (*args)
+            except:
+                nonfatalException ()
+                errback (sys.exc_info ())
+                return
+
+        if callback != None:
+            callback (result)
+
+    def report_error (self, error):
+        if error[0] == 'ipp':
+            (kind, e, m) = error
+            self.watcher.cups_ipp_error (self, e, m)
+        else:
+            self.watcher.cups_connection_error (self)
+
+    def scheduled_fetch (self):
+        self.get_notifications ()
+
+    def fetch_failed (self, exc_info):
+        self.poll_later (failed=True)
+        self.scheduler.finished ()
+
+    def poll_later (self, failed=False):
+        """Asks for notifications to be fetched again after the
+        server's notify-get-interval or, after a failure, after a retry
+        interval that grows with each failure in a row.  Nothing is
+        scheduled once CUPS D-Bus signals tell us when to fetch."""
+        if self.received_any_dbus_signals:
+            return
+
+        if failed:
+            self.poll_failures += 1
+            interval = min (POLL_RETRY_INTERVAL *
+                            2 ** (self.poll_failures - 1),
+                            POLL_RETRY_MAX)
+        else:
+            self.poll_failures = 0
+            interval = self.poll_interval
+
+        self.scheduler.schedule (1000 * interval)
 
     def get_notifications(self):
-        debugprint ("get_notifications")
-        user = cups.getUser ()
-        try:
-            cups.setUser (self.user)
-            c = cups.Connection (host=self.host,
-                                 port=self.port,
-                                 encryption=self.encryption)
+        """Fetches and processes pending events.  This is called by
+        the scheduler, which is told when we have finished."""
+        log.debug ("get_notifications")
+        if self.refreshing:
+            # refresh_done will ask for another fetch.
+            self.scheduler.finished ()
+            return False
 
+        if not self.sub_ids:
+            # We have no subscription to ask about: try for one again.
+            self.scheduler.finished ()
+            self.refresh ()
+            return False
+
+        self.run_io (self.io_get_notifications,
+                     (tuple (self.sub_ids), self.sub_seqs.copy ()),
+                     self.notifications_fetched, self.fetch_failed)
+        return False
+
+    def io_get_notifications (self, sub_ids, sub_seqs):
+        """Fetches the pending events for all our subscriptions with a
+        single request."""
+        c = self.connection
+        try:
             try:
-                try:
-                    notifications = c.getNotifications ([self.sub_id],
-                                                        [self.sub_seq + 1])
-                except AttributeError:
-                    notifications = c.getNotifications ([self.sub_id])
-            except cups.IPPError, (e, m):
-                cups.setUser (user)
-                if e == cups.IPP_NOT_FOUND:
-                    # Subscription lease has expired.
-                    self.sub_id = -1
-                    self.refresh ()
-                    return False
-
-                self.watcher.cups_ipp_error (self, e, m)
-                return True
-        except RuntimeError:
-            cups.setUser (user)
-            self.watcher.cups_connection_error (self)
-            return True
+                if not sub_seqs:
+                    raise AttributeError
+                seqs = [sub_seqs.get (sub_id, 0) + 1 for sub_id in sub_ids]
+                notifications = c.getNotifications (list (sub_ids), seqs)
+            except AttributeError:
+                notifications = c.getNotifications (list (sub_ids))
+        except cups.IPPError, (e, m):
+            return (sub_ids, None, ('ipp', e, m))
+        except (RuntimeError, cups.HTTPError):
+            return (sub_ids, None, ('connection',))
+
+        if len (sub_ids) > 1:
+            merge_notifications (notifications['events'])
+
+        return (sub_ids, notifications, None)
+
+    def notifications_fetched (self, result):
+        (sub_ids, notifications, error) = result
+        if sub_ids != tuple (self.sub_ids):
+            # The subscriptions were replaced while we were waiting.
+            self.scheduler.finished ()
+            return
+
+        metrics.count ('notifications.batches')
+        if error != None:
+            if error[0] == 'ipp' and error[1] == cups.IPP_NOT_FOUND:
+                # Subscription lease has expired.
+                metrics.count ('subscription.expired')
+                self.refresh ()
+            else:
+                self.report_error (error)
+                self.poll_later (failed=True)
+
+            self.scheduler.finished ()
+            return
+
+        # Fetch the attributes of all the new jobs in this batch in
+        # one go, rather than one request per job.
+        new_jobids = set()
+        for event in notifications['events']:
+            nse = event['notify-subscribed-event']
+            if not nse.startswith ("job-"):
+                continue
+            jobid = event['notify-job-id']
+            if (nse == 'job-created' or
+                (nse == 'job-state-changed' and
+                 not self.jobs.has_key (jobid) and
+                 event['job-state'] == cups.IPP_JOB_PROCESSING)):
+                if (self.specific_dests != None and
+                    event['printer-name'] not in self.specific_dests):
+                    continue
+                new_jobids.add (jobid)
+
+        if not new_jobids:
+            self.process_notifications (notifications, ({}, []))
+            return
+
+        self.run_io (self.io_fetch_job_attributes, (new_jobids,),
+                     lambda fetched: self.process_notifications (notifications,
+                                                                 fetched),
+                     self.fetch_failed)
+
+    def process_notifications (self, notifications, fetched):
+        try:
+            self.handle_notifications (notifications, fetched)
+        finally:
+            self.scheduler.finished ()
+
+    def handle_notifications (self, notifications, fetched):
+        (new_jobs, errors) = fetched
+        for error in errors:
+            self.report_error (error)
 
-        cups.setUser (user)
         deferred_calls = []
-        jobs = self.jobs.copy ()
+        changed = set()
+        dirty_printers = set()
+        resubscribe = False
+        jobs = self.writable_jobs ()
         for event in notifications['events']:
             seq = event['notify-sequence-number']
-            self.sub_seq = seq
+            self.sub_seqs[event['notify-subscription-id']] = seq
             nse = event['notify-subscribed-event']
-            debugprint ("%d %s %s" % (seq, nse, event['notify-text']))
-            if get_debugging ():
-                debugprint (pprint.pformat (event))
+            metrics.count ('events.%s' % nse)
+            if log.debugging:
+                log.debug ("%d %s %s", seq, nse, event['notify-text'])
+                log.debug ("%s", pprint.pformat (event))
             if nse.startswith ('printer-'):
                 # Printer events
                 name = event['printer-name']
                 if nse == 'printer-added' and name not in self.printers:
                     self.printers.add (name)
+                    if (self.specific_dests != None and
+                        name in self.specific_dests and
+                        name not in self.subscribed_dests):
+                        # A queue we are watching has turned up.
+                        resubscribe = True
+                    if (self.specific_dests == None or
+                        name in self.specific_dests):
+                        self.update_printer_snapshot (name, event)
                     deferred_calls.append ((self.watcher.printer_added,
                                             (self, name)))
 
                 elif nse == 'printer-deleted' and name in self.printers:
                     self.printers.remove (name)
-                    items = self.reasons_seen.keys ()
-                    for tuple in items:
-                        if tuple[1] == name:
-                            reason = self.reasons_seen[tuple]
-                            del self.reasons_seen[tuple]
-                            deferred_calls.append ((self.watcher.state_reason_removed,
-                                                    (self, reason)))
-                            
+                    dirty_printers.add (name)
                     if self.printer_state_reasons.has_key (name):
                         del self.printer_state_reasons[name]
+                    if self.printer_snapshot.has_key (name):
+                        del self.printer_snapshot[name]
 
                     deferred_calls.append ((self.watcher.printer_removed,
                                             (self, name)))
@@ -367,6 +956,8 @@ class Monitor:
                             continue
                         reasons.append (StateReason (name, reason))
                     self.printer_state_reasons[name] = reasons
+                    dirty_printers.add (name)
+                    self.update_printer_snapshot (name, event)
 
                     deferred_calls.append ((self.watcher.printer_event,
                                             (self, name, nse, event)))
@@ -376,7 +967,7 @@ class Monitor:
             if not nse.startswith ("job-"):
                 # Some versions of CUPS give empty
                 # notify-subscribed-event attributes (STR #3608).
-                debugprint ("Unhandled nse %s" % repr (nse))
+                log.debug ("Unhandled nse %r", nse)
                 continue
 
             jobid = event['notify-job-id'] #BREAKAGE!
@@ -389,29 +980,22 @@ class Monitor:
                     continue
 
                 try:
-                    attrs = c.getJobAttributes (jobid)
-                    if (self.my_jobs and
-                        attrs['job-originating-user-name'] != cups.getUser ()):
-                        continue
-
-                    jobs[jobid] = attrs
-                except AttributeError:
-                    jobs[jobid] = {'job-k-octets': 0}
-                except cups.IPPError, (e, m):
-                    self.watcher.cups_ipp_error (self, e, m)
-                    jobs[jobid] = {'job-k-octets': 0}
+                    jobs[jobid] = JobRecord.core (new_jobs[jobid])
                 except KeyError:
-                    jobs[jobid] = {'job-k-octets': 0}
+                    # Not one of ours, or already gone.
+                    continue
 
+                changed.add (jobid)
                 deferred_calls.append ((self.watcher.job_added,
                                         (self, jobid, nse, event,
-                                         jobs[jobid].copy ())))
+                                         jobs[jobid])))
             elif (nse == 'job-completed' or
                   (nse == 'job-state-changed' and
                    event['job-state'] == cups.IPP_JOB_COMPLETED)):
                 if not (self.which_jobs in ['completed', 'all']):
                     try:
                         del jobs[jobid]
+                        changed.add (jobid)
                         deferred_calls.append ((self.watcher.job_removed,
                                                 (self, jobid, nse, event)))
                     except KeyError:
@@ -423,60 +1007,239 @@ class Monitor:
             except KeyError:
                 continue
 
+            attrs = {}
             for attribute in ['job-state',
                               'job-name']:
-                job[attribute] = event[attribute]
+                attrs[attribute] = event[attribute]
             if event.has_key ('notify-printer-uri'):
-                job['job-printer-uri'] = event['notify-printer-uri']
+                attrs['job-printer-uri'] = event['notify-printer-uri']
 
+            job = job.updated (attrs)
+            jobs[jobid] = job
+            changed.add (jobid)
             deferred_calls.append ((self.watcher.job_event,
-                                   (self, jobid, nse, event, job.copy ())))
+                                   (self, jobid, nse, event, job)))
 
+        if deferred_calls:
+            self.apply_jobs (jobs, deferred_calls, changed, dirty_printers)
+
+        if resubscribe:
+            # Subscribe to the new queue's events.
+            self.refresh ()
+            return
+
+        # Update again when we're told to.  If we're getting CUPS
+        # D-Bus signals, however, rely on those instead.
+        self.poll_interval = notifications.get ('notify-get-interval',
+                                                self.poll_interval)
+        self.poll_later ()
+
+    def update_printer_snapshot (self, name, event):
+        attrs = { 'printer-name': name }
+        for attribute in ['printer-state', 'printer-state-reasons']:
+            if event.has_key (attribute):
+                attrs[attribute] = event[attribute]
+        if event.has_key ('notify-printer-uri'):
+            attrs['printer-uri-supported'] = event['notify-printer-uri']
+        try:
+            printer = self.printer_snapshot[name].updated (attrs)
+        except KeyError:
+            printer = PrinterRecord (attrs)
+        self.printer_snapshot[name] = printer
+
+    def apply_jobs (self, jobs, deferred_calls, changed, dirty_printers=set()):
+        """Install a new jobs dict and then run the watcher calls that
+        describe how it differs from the old one.  changed is the set
+        of job IDs that were added, altered or removed, and
+        dirty_printers the printers whose state reasons have been
+        replaced."""
         self.set_process_pending (False)
-        self.update_jobs (jobs)
+        printers = self.job_index.update (jobs, changed)
+        printers.update (dirty_printers)
+        self.check_state_reasons (printers)
         self.jobs = jobs
 
+        start = time.time ()
         for (fn, args) in deferred_calls:
+            span = tracing.begin (fn.__name__, 'watcher')
             fn (*args)
+            tracing.end (span)
+        metrics.observe ('watcher.callbacks', time.time () - start)
         self.set_process_pending (True)
 
-        # Update again when we're told to.  If we're getting CUPS
-        # D-Bus signals, however, rely on those instead.
-        if not self.received_any_dbus_signals:
-            interval = 1000 * notifications['notify-get-interval']
-            QTimer.singleShot(interval, self.get_notifications)
+    def filter_specific_dests (self, jobs):
+        if self.specific_dests == None:
+            return
 
-        return False
+        for jobid in jobs.keys ():
+            uri = jobs[jobid].get('job-printer-uri', '/')
+            printer = printer_name_from_uri (uri)
+            if printer not in self.specific_dests:
+                del jobs[jobid]
 
-    def refresh(self, which_jobs=None, refresh_all=True):
-        debugprint ("refresh")
+    def reconcile_jobs (self, fetched):
+        """Compare a freshly fetched jobs dict against what we know and
+        tell the watcher only about the differences."""
+        deferred_calls = []
+        changed = set()
+        jobs = self.writable_jobs ()
+        for jobid in jobs.keys ():
+            if not fetched.has_key (jobid):
+                del jobs[jobid]
+                changed.add (jobid)
+                deferred_calls.append ((self.watcher.job_removed,
+                                        (self, jobid, '', {})))
+
+        for jobid, job in fetched.iteritems ():
+            if not jobs.has_key (jobid):
+                job = JobRecord.core (job)
+                jobs[jobid] = job
+                changed.add (jobid)
+                deferred_calls.append ((self.watcher.job_added,
+                                        (self, jobid, '', {}, job)))
+                continue
 
-        if which_jobs != None:
-            self.which_jobs = which_jobs
+            old = jobs[jobid]
+            if job_changed (old, job):
+                job = old.updated (job)
+                jobs[jobid] = job
+                changed.add (jobid)
+                deferred_calls.append ((self.watcher.job_event,
+                                        (self, jobid, '', {}, job)))
+
+        self.apply_jobs (jobs, deferred_calls, changed)
+
+    def delta_refresh (self, reconcile_jobs=False):
+        """Bring our view up to date while keeping the subscription.
+
+        Pending events are collected with getNotifications; if the
+        subscription has gone away that falls back to a full refresh.
+        The job list is only fetched when which_jobs now asks for
+        completed jobs we don't have."""
+        log.debug ("delta_refresh")
+        if reconcile_jobs and self.monitor_jobs:
+            if self.which_jobs in ['completed', 'all']:
+                self.start_fetch_jobs (refresh_all=False)
+            else:
+                # Just forget the jobs that have finished, and stop
+                # any fetch that would bring them back.
+                self.fetch_jobs_generation += 1
+                fetched = {}
+                for jobid, job in self.jobs.iteritems ():
+                    state = job.get ('job-state', cups.IPP_JOB_CANCELED)
+                    if state < cups.IPP_JOB_CANCELED:
+                        fetched[jobid] = job
+
+                self.reconcile_jobs (fetched)
+
+        self.scheduler.schedule (0)
+        return False
 
-        user = cups.getUser ()
-        try:
-            cups.setUser (self.user)
-            c = cups.Connection (host=self.host,
-                                 port=self.port,
-                                 encryption=self.encryption)
-        except RuntimeError:
-            self.watcher.cups_connection_error (self)
-            cups.setUser (user)
-            return
+    def io_fetch_job_attributes (self, jobids):
+        """Fetches the attributes we use for a set of new jobs.  Jobs
+        with nearby IDs are fetched together with a single getJobs
+        request.  Returns a dict of job ID to attributes for the jobs
+        we should be showing, and a list of errors to report."""
+        result = {}
+        errors = []
+        jobids = list (jobids)
+        jobids.sort ()
+        runs = []
+        for jobid in jobids:
+            if runs and jobid - runs[-1][0] < JOB_BATCH_SIZE:
+                runs[-1].append (jobid)
+            else:
+                runs.append ([jobid])
 
-        if self.sub_id != -1:
+        c = self.connection
+        for run in runs:
+            first = run[0]
             try:
-                c.cancelSubscription (self.sub_id)
+                fetched = c.getJobs (which_jobs="all",
+                                     my_jobs=self.my_jobs,
+                                     first_job_id=first,
+                                     limit=run[-1] - first + 1,
+                                     requested_attributes=JOB_ATTRIBUTES)
+                if fetched and min (fetched.keys ()) < first:
+                    # The server doesn't understand first-job-id, so
+                    # this is the start of the job list, not our run.
+                    raise TypeError
+            except TypeError:
+                # first_job_id, limit and requested_attributes are
+                # not supported by this version of pycups or CUPS.
+                result.update (self.io_fetch_job_attributes_singly (run,
+                                                                    errors))
+                continue
             except cups.IPPError, (e, m):
-                self.watcher.cups_ipp_error (self, e, m)
+                errors.append (('ipp', e, m))
+                fetched = {}
+                for jobid in run:
+                    fetched[jobid] = {'job-k-octets': 0}
+            except (RuntimeError, cups.HTTPError):
+                errors.append (('connection',))
+                fetched = {}
+                for jobid in run:
+                    fetched[jobid] = {'job-k-octets': 0}
+
+            # With my_jobs set the server has already left out
+            # other users' jobs.
+            for jobid in run:
+                if fetched.has_key (jobid):
+                    result[jobid] = fetched[jobid]
+
+        return (result, errors)
+
+    def io_fetch_job_attributes_singly (self, jobids, errors):
+        result = {}
+        c = self.connection
+        for jobid in jobids:
+            try:
+                attrs = c.getJobAttributes (jobid)
+                if (self.my_jobs and
+                    attrs['job-originating-user-name'] != self.user):
+                    continue
 
-            debugprint ("Canceled subscription %d" % self.sub_id)
+                result[jobid] = attrs
+            except AttributeError:
+                result[jobid] = {'job-k-octets': 0}
+            except cups.IPPError, (e, m):
+                errors.append (('ipp', e, m))
+                result[jobid] = {'job-k-octets': 0}
+            except KeyError:
+                result[jobid] = {'job-k-octets': 0}
+        return result
 
+    def fetch_all_jobs (self, which_jobs):
+        c = self.connection
         try:
-            del self.sub_seq
-        except AttributeError:
-            pass
+            return c.getJobs (which_jobs=which_jobs,
+                              my_jobs=self.my_jobs,
+                              requested_attributes=JOB_ATTRIBUTES)
+        except TypeError:
+            # requested_attributes argument is not supported by this
+            # version of pycups.
+            return c.getJobs (which_jobs=which_jobs,
+                              my_jobs=self.my_jobs)
+
+    def refresh(self, which_jobs=None, refresh_all=True):
+        log.debug ("refresh")
+
+        reconcile_jobs = False
+        if which_jobs != None:
+            reconcile_jobs = which_jobs != self.which_jobs
+            self.which_jobs = which_jobs
+
+        if self.refreshing:
+            # Do it again once the one in progress has finished.
+            self.refresh_again = True
+            return False
+
+        if not refresh_all and self.sub_ids:
+            return self.delta_refresh (reconcile_jobs)
+
+        old_sub_ids = self.sub_ids
+        self.sub_ids = []
+        self.sub_seqs = {}
 
         events = ["printer-added",
                   "printer-deleted",
@@ -488,217 +1251,423 @@ class Monitor:
                             "job-progress",
                             "job-state-changed"])
 
+        plan = subscription_plan (events, self.specific_dests)
+        metrics.count ('monitor.refreshes')
+        self.refresh_span = tracing.begin ('refresh', 'cycle',
+                                           { 'server': self.get_server_name () })
+        self.refreshing = True
+        self.run_io (self.io_refresh, (old_sub_ids, plan),
+                     self.refresh_done, self.refresh_failed)
+        return False
+
+    def io_refresh (self, old_sub_ids, plan):
+        """Replaces the subscriptions and fetches the printer list."""
+        c = self.connection
+        result = { 'sub-ids': [],
+                   'dests': set(),
+                   'errors': [] }
         try:
-            self.sub_id = c.createSubscription ("/", events=events)
+            for sub_id in old_sub_ids:
+                try:
+                    c.cancelSubscription (sub_id)
+                    log.debug ("Canceled subscription %d", sub_id)
+                except cups.IPPError, (e, m):
+                    if e != cups.IPP_NOT_FOUND:
+                        result['errors'].append (('ipp', e, m))
+
+            for (uri, events) in plan:
+                try:
+                    sub_id = c.createSubscription (uri, events=events,
+                                                   lease_duration=SUBSCRIPTION_LEASE)
+                except cups.IPPError, (e, m):
+                    if e == cups.IPP_NOT_FOUND and uri != "/":
+                        # No such queue yet.  We'll hear about it
+                        # from the "/" subscription if it is added.
+                        log.debug ("Not subscribing to %s: %s", uri, m)
+                    else:
+                        result['errors'].append (('ipp', e, m))
+                    continue
+
+                result['sub-ids'].append (sub_id)
+                if uri != "/":
+                    result['dests'].add (printer_name_from_uri (uri))
+
+            if result['sub-ids']:
+                result['lease-duration'] = \
+                    fetch_lease_duration (c, result['sub-ids'],
+                                          SUBSCRIPTION_LEASE)
+
+            result['printers'] = fetch_printer_snapshot (c)
         except cups.IPPError, (e, m):
-            self.watcher.cups_ipp_error (self, e, m)
+            result['errors'].append (('ipp', e, m))
+        except (RuntimeError, cups.HTTPError):
+            result['errors'].append (('connection',))
+
+        return result
+
+    ## Subscription lease
+    def set_lease (self, duration):
+        """Notes the lease we now have on the subscription and arranges
+        to renew it halfway through.  A duration of 0 means the lease
+        never expires."""
+        self.lease_timer.stop ()
+        self.lease_duration = duration
+        if not duration:
+            self.lease_expires = None
+            return
+
+        self.lease_expires = time.time () + duration
+        self.lease_timer.start (int (duration * 1000 / 2))
 
-        cups.setUser (user)
+    def renew_lease (self):
+        if not self.sub_ids or self.refreshing:
+            # New subscriptions are on their way.
+            return
 
-        QTimer.singleShot(MIN_REFRESH_INTERVAL * 1000, self.get_notifications)
-        debugprint ("Created subscription %d" % self.sub_id)
+        log.debug ("Renewing subscriptions %r", self.sub_ids)
+        self.run_io (self.io_renew_lease, (tuple (self.sub_ids),),
+                     self.lease_renewed, self.lease_renew_failed)
 
-        # Doesn't work, and I don't know how to fix at the moment
-        #if self.monitor_jobs:
-            #jobs = self.jobs.copy ()
-            #if self.which_jobs not in ['all', 'completed']:
-                ## Filter out completed jobs.
-                #filtered = {}
-                #for jobid, job in jobs.iteritems ():
-                    #if job['job-state'] < cups.IPP_JOB_CANCELED:
-                        #filtered[jobid] = job
-                #jobs = filtered
+    def io_renew_lease (self, sub_ids):
+        for sub_id in sub_ids:
+            try:
+                self.connection.renewSubscription (sub_id,
+                                                   lease_duration=SUBSCRIPTION_LEASE)
+            except cups.IPPError, (e, m):
+                return (sub_ids, ('ipp', e, m))
+            except (RuntimeError, cups.HTTPError):
+                return (sub_ids, ('connection',))
 
-            #self.fetch_first_job_id = 1
-            #QTimer.singleShot(MIN_REFRESH_INTERVAL * 1000, self.fetch_jobs)
-        #else:
-            #jobs = {}
+        return (sub_ids, None)
+
+    def lease_renewed (self, result):
+        (sub_ids, error) = result
+        if sub_ids != tuple (self.sub_ids):
+            return
+
+        if error == None:
+            self.lease_renewals += 1
+            metrics.count ('subscription.renewals')
+            self.set_lease (min (SUBSCRIPTION_LEASE, self.lease_duration))
+            return
+
+        self.lease_failures += 1
+        if error[0] == 'ipp' and error[1] == cups.IPP_NOT_FOUND:
+            # Too late: the lease has already expired.
+            self.refresh ()
+            return
 
+        self.lease_renew_failed (None)
+
+    def lease_renew_failed (self, exc_info):
+        # Try again soon, as long as there's time left.
+        if self.lease_expires == None:
+            return
+
+        remaining = self.lease_expires - time.time ()
+        retry = min (LEASE_RETRY_INTERVAL, remaining / 2)
+        if retry > 0:
+            self.lease_timer.start (int (retry * 1000))
+
+    def get_lease_state (self):
+        """Returns a dict describing the subscription lease."""
+        if self.lease_expires == None:
+            remaining = None
+        else:
+            remaining = max (0, self.lease_expires - time.time ())
+        return { 'sub-ids': list (self.sub_ids),
+                 'lease-duration': self.lease_duration,
+                 'lease-remaining': remaining,
+                 'renewals': self.lease_renewals,
+                 'renewal-failures': self.lease_failures }
+
+    def refresh_failed (self, exc_info):
+        self.refreshing = False
+        self.refresh_again = False
+        tracing.end (self.refresh_span)
+        self.refresh_span = None
+        # Without a subscription, the next poll tries again.
+        self.poll_later (failed=True)
+
+    def refresh_done (self, result):
+        span = self.refresh_span
+        self.refresh_span = None
         try:
-            if self.monitor_jobs:
-                jobs = c.getJobs (which_jobs=self.which_jobs,
-                                  my_jobs=self.my_jobs)
-            else:
-                jobs = {}
-            self.printer_state_reasons = collect_printer_state_reasons (c)
-            dests = c.getPrinters ()
-            self.printers = set(dests.keys ())
-        except cups.IPPError, (e, m):
-            self.watcher.cups_ipp_error (self, e, m)
+            self.apply_refresh (result)
+        finally:
+            tracing.end (span)
+
+    def apply_refresh (self, result):
+        self.refreshing = False
+        self.sub_ids = result['sub-ids']
+        self.subscribed_dests = result['dests']
+        for error in result['errors']:
+            self.report_error (error)
+
+        if self.sub_ids:
+            log.debug ("Created subscriptions %r", self.sub_ids)
+            self.scheduler.schedule (MIN_REFRESH_INTERVAL * 1000)
+            self.set_lease (result['lease-duration'])
+        else:
+            self.set_lease (None)
+            # The next poll tries to subscribe again.
+            self.poll_later (failed=True)
+
+        if self.refresh_again:
+            self.refresh_again = False
+            self.refresh ()
             return
-        except RuntimeError:
-            self.watcher.cups_connection_error (self)
+
+        if not result.has_key ('printers'):
             return
 
+        printers = result['printers']
+        self.printers = set(printers.keys ())
         if self.specific_dests != None:
-            for jobid in jobs.keys ():
-                uri = jobs[jobid].get('job-printer-uri', '/')
-                i = uri.rfind ('/')
-                printer = uri[i + 1:]
-                if printer not in self.specific_dests:
-                    del jobs[jobid]
+            # We only hear about changes to the queues we watch, so
+            # only keep those; anything else would go stale.
+            watched = {}
+            for name in self.specific_dests:
+                if printers.has_key (name):
+                    watched[name] = printers[name]
+            printers = watched
+        self.printer_snapshot = printers
+        self.printer_state_reasons = collect_printer_state_reasons (printers,
+                                                                    self.specific_dests)
+
+        # Start with the jobs we already know about; the job list is
+        # then fetched a page at a time.
+        if self.monitor_jobs:
+            jobs = self.jobs
+            if self.which_jobs not in ['all', 'completed']:
+                # Filter out completed jobs.
+                filtered = {}
+                for jobid, job in jobs.iteritems ():
+                    state = job.get ('job-state', cups.IPP_JOB_CANCELED)
+                    if state < cups.IPP_JOB_CANCELED:
+                        filtered[jobid] = job
+                jobs = filtered
+        else:
+            jobs = {}
 
         self.set_process_pending (False)
-        self.watcher.current_printers_and_jobs (self, self.printers.copy (),
-                                                jobs.copy ())
-        self.update_jobs (jobs)
         self.jobs = jobs
+        start = time.time ()
+        span = tracing.begin ('current_printers_and_jobs', 'watcher')
+        self.watcher.current_printers_and_jobs (self, self.printers.copy (),
+                                                self.get_jobs ())
+        tracing.end (span)
+        metrics.observe ('watcher.callbacks', time.time () - start)
+        self.job_index.rebuild (jobs)
+        self.check_state_reasons ()
         self.set_process_pending (True)
-        return False
 
-        self.jobs = jobs
-        return False
+        if self.monitor_jobs:
+            self.start_fetch_jobs ()
+
+    def start_fetch_jobs (self, refresh_all=True):
+        """Starts fetching the job list a page at a time.  Each page
+        is passed to the watcher as soon as it arrives.  With
+        refresh_all false, jobs we already know about are only
+        reported if they have changed."""
+        self.fetch_jobs_generation += 1
+        self.fetch_first_job_id = 1
+        self.fetch_refresh_all = refresh_all
+        self.fetch_known_jobids = self.jobs.keys ()
+        self.fetch_known_jobids.sort ()
+        self.fetch_jobs (self.fetch_jobs_generation)
+
+    def fetch_jobs (self, generation):
+        if generation != self.fetch_jobs_generation:
+            # A newer fetch has started since this page was asked for.
+            return
 
-    def sort_jobs_by_printer (self, jobs=None):
-        if jobs == None:
-            jobs = self.jobs
+        self.run_io (self.io_fetch_job_page,
+                     (generation, self.which_jobs, self.fetch_first_job_id,
+                      self.job_page_size),
+                     self.job_page_fetched)
 
-        my_printers = set()
-        printer_jobs = {}
-        for job, data in jobs.iteritems ():
-            state = data.get ('job-state', cups.IPP_JOB_CANCELED)
-            if state >= cups.IPP_JOB_CANCELED:
-                continue
-            uri = data.get ('job-printer-uri', '')
-            i = uri.rfind ('/')
-            if i == -1:
-                continue
-            printer = uri[i + 1:]
-            my_printers.add (printer)
-            if not printer_jobs.has_key (printer):
-                printer_jobs[printer] = {}
-            printer_jobs[printer][job] = data
+    def io_fetch_job_page (self, generation, which_jobs, first_job_id, limit):
+        c = self.connection
+        complete = False
+        try:
+            try:
+                fetched = c.getJobs (which_jobs=which_jobs,
+                                     my_jobs=self.my_jobs,
+                                     first_job_id=first_job_id,
+                                     limit=limit,
+                                     requested_attributes=JOB_ATTRIBUTES)
+                if fetched and min (fetched.keys ()) < first_job_id:
+                    # The server doesn't understand first-job-id.
+                    raise TypeError
+            except TypeError:
+                # Paging is not supported by this version of pycups
+                # or CUPS, so fetch them all at once.
+                fetched = self.fetch_all_jobs (which_jobs)
+                complete = True
+        except cups.IPPError, (e, m):
+            return (generation, first_job_id, limit, None, complete,
+                    ('ipp', e, m))
+        except (RuntimeError, cups.HTTPError):
+            return (generation, first_job_id, limit, None, complete,
+                    ('connection',))
 
-        return (printer_jobs, my_printers)
+        return (generation, first_job_id, limit, fetched, complete, None)
 
-    def fetch_jobs (self, refresh_all):
-        if not self.process_pending_events:
-            # Skip this call.  We'll get called again soon.
-            return True
+    def job_page_fetched (self, result):
+        (generation, first_job_id, limit, fetched, complete, error) = result
+        if generation != self.fetch_jobs_generation:
+            return
 
-        user = cups.getUser ()
-        try:
-            cups.setUser (self.user)
-            c = cups.Connection (host=self.host,
-                                 port=self.port,
-                                 encryption=self.encryption)
-        except RuntimeError:
-            self.watcher.cups_connection_error (self)
-            self.fetch_jobs_timer = None
-            cups.setUser (user)
-            return False
+        if error != None:
+            self.report_error (error)
+            return
 
-        limit = 1
-        try:
-            fetched = c.getJobs (which_jobs=self.which_jobs,
-                                 my_jobs=self.my_jobs,
-                                 first_job_id=self.fetch_first_job_id,
-                                 limit=limit)
-        except cups.IPPError, (e, m):
-            self.watcher.cups_ipp_error (self, e, m)
-            self.fetch_jobs_timer = None
-            cups.setUser (user)
-            return False
+        if complete:
+            self.filter_specific_dests (fetched)
+            self.reconcile_jobs (fetched)
+            self.watcher.jobs_fetched (self)
+            return
 
-        cups.setUser (user)
         got = len (fetched)
-        debugprint ("Got %s jobs, asked for %s" % (got, limit))
-
-        deferred_calls = []
-        jobs = self.jobs.copy ()
+        log.debug ("Got %s jobs, asked for %s", got, limit)
         jobids = fetched.keys ()
         jobids.sort ()
-        if got > 0:
-            last_jobid = jobids[got - 1]
+        self.filter_specific_dests (fetched)
+        last_page = got < limit
+
+        # Any job we knew about in the range covered by this page (or
+        # anywhere after it, for the last page) that wasn't in the
+        # page has gone.
+        known = self.fetch_known_jobids
+        lo = bisect.bisect_left (known, first_job_id)
+        if last_page:
+            hi = len (known)
         else:
-            last_jobid = self.fetch_first_job_id + limit
-        for jobid in xrange (self.fetch_first_job_id, last_jobid + 1):
-            try:
-                job = fetched[jobid]
-                if self.specific_dests != None:
-                    uri = job.get('job-printer-uri', '/')
-                    i = uri.rfind ('/')
-                    printer = uri[i + 1:]
-                    if printer not in self.specific_dests:
-                        raise KeyError
-
-                if jobs.has_key (jobid):
-                    fn = self.watcher.job_event
-                else:
-                    fn = self.watcher.job_added
-
-                jobs[jobid] = job
-                deferred_calls.append ((fn,
-                                        (self, jobid, '', {}, job.copy ())))
-            except KeyError:
-                # No job by that ID.
-                if jobs.has_key (jobid):
-                    del jobs[jobid]
-                    deferred_calls.append ((self.watcher.job_removed,
-                                            (self, jobid, '', {})))
-
-        jobids = jobs.keys ()
-        jobids.sort ()
-        if got < limit:
-            trim = False
-            for i in range (len (jobids)):
-                jobid = jobids[i]
-                if not trim and jobid > last_jobid:
-                    trim = True
-
-                if trim:
-                    del jobs[jobid]
-                    deferred_calls.append ((self.watcher.job_removed,
-                                            (self, jobid, '', {})))
-
-        self.update_jobs (jobs)
-        self.jobs = jobs
-
-        for (fn, args) in deferred_calls:
-            fn (*args)
-
-        if got < limit:
-            # That's all.  Don't run this timer again.
-            self.fetch_jobs_timer = None
-            return False
+            hi = bisect.bisect_right (known, jobids[-1])
 
-        # Remember where we got up to and run this timer again.
-        next = jobid + 1
+        deferred_calls = []
+        changed = set()
+        jobs = self.writable_jobs ()
+        for jobid in known[lo:hi]:
+            if jobs.has_key (jobid) and not fetched.has_key (jobid):
+                del jobs[jobid]
+                changed.add (jobid)
+                deferred_calls.append ((self.watcher.job_removed,
+                                        (self, jobid, '', {})))
+
+        for jobid in jobids:
+            if not fetched.has_key (jobid):
+                continue
 
-        while not refresh_all and self.jobs.has_key (next):
-            next += 1
+            job = fetched[jobid]
+            if jobs.has_key (jobid):
+                old = jobs[jobid]
+                if not (self.fetch_refresh_all or job_changed (old, job)):
+                    continue
 
-        self.fetch_first_job_id = next
-        return True
+                job = old.updated (job)
+                fn = self.watcher.job_event
+            else:
+                job = JobRecord.core (job)
+                fn = self.watcher.job_added
 
-    def sort_jobs_by_printer (self, jobs=None):
-        if jobs == None:
-            jobs = self.jobs
+            jobs[jobid] = job
+            changed.add (jobid)
+            deferred_calls.append ((fn, (self, jobid, '', {}, job)))
 
-        my_printers = set()
-        printer_jobs = {}
-        for job, data in jobs.iteritems ():
-            state = data.get ('job-state', cups.IPP_JOB_CANCELED)
-            if state >= cups.IPP_JOB_CANCELED:
-                continue
-            uri = data.get ('job-printer-uri', '')
-            i = uri.rfind ('/')
-            if i == -1:
-                continue
-            printer = uri[i + 1:]
-            my_printers.add (printer)
-            if not printer_jobs.has_key (printer):
-                printer_jobs[printer] = {}
-            printer_jobs[printer][job] = data
+        self.apply_jobs (jobs, deferred_calls, changed)
 
-        return (printer_jobs, my_printers)
+        if last_page:
+            # That's all.
+            self.fetch_known_jobids = []
+            self.watcher.jobs_fetched (self)
+            return
 
-    def update_jobs(self, jobs):
-        debugprint ("update_jobs")
-        (printer_jobs, my_printers) = self.sort_jobs_by_printer (jobs)
-        self.check_state_reasons (my_printers, printer_jobs)
+        # Remember where we got up to and fetch the next page once
+        # the main loop has had a chance to run.
+        self.fetch_first_job_id = jobids[-1] + 1
+        QTimer.singleShot (0, lambda: self.fetch_jobs (generation))
 
     def handle_dbus_signal(self, *args):
-        QTimer.singleShot(200, self.get_notifications)
+        self.scheduler.request ()
         if not self.received_any_dbus_signals:
             self.received_any_dbus_signals = True
+
+def recording_name (filename, index, count):
+    if filename == None or count == 1:
+        return filename
+    return "%s.%d" % (filename, index)
+
+class MultiServerMonitor:
+    """Monitors several CUPS servers at once.
+
+    Each server gets its own Monitor, with its own subscription,
+    connection and worker thread, so a slow server doesn't hold up
+    the others.  Watcher calls carry the Monitor they came from, which
+    tells the watcher which server a job or printer belongs to.
+
+    servers is a list of 'host[:port]' strings.  None in that list
+    means the default server.
+
+    With record, each server's requests are written to that file
+    (with the server's index appended when there is more than one).
+    With replay, the servers' requests are answered from recordings
+    named in the same way, at replay_speed times the recorded speed."""
+
+    def __init__(self, watcher, servers=None, bus=None, my_jobs=True,
+                 specific_dests=None, monitor_jobs=True,
+                 record=None, replay=None, replay_speed=1.0):
+        if servers == None:
+            servers = [None]
+
+        self.monitors = []
+        for i in range (len (servers)):
+            server = servers[i]
+            if server == None:
+                (host, port) = (cups.getServer (), None)
+            else:
+                (host, port) = parse_server (server)
+
+            record_file = recording_name (record, i, len (servers))
+            replay_file = recording_name (replay, i, len (servers))
+            connection = None
+            use_dbus = server_is_local (host)
+            if replay_file != None:
+                import recorder
+                connection = recorder.ReplayConnection (replay_file,
+                                                        speed=replay_speed)
+                use_dbus = False
+
+            worker = ippworker.IPPWorker ()
+            mon = Monitor (watcher, bus=bus, my_jobs=my_jobs,
+                           specific_dests=specific_dests,
+                           monitor_jobs=monitor_jobs,
+                           host=host, port=port, worker=worker,
+                           use_dbus=use_dbus, connection=connection,
+                           record=record_file)
+            self.monitors.append (mon)
+
+    def get_local_monitor (self):
+        for mon in self.monitors:
+            if server_is_local (mon.host):
+                return mon
+        return None
+
+    def get_jobs (self):
+        """Returns the jobs from every server, keyed by (Monitor,
+        job ID)."""
+        jobs = {}
+        for mon in self.monitors:
+            for jobid, job in mon.get_jobs ().iteritems ():
+                jobs[(mon, jobid)] = job
+        return jobs
+
+    def refresh (self, which_jobs=None, refresh_all=True):
+        for mon in self.monitors:
+            mon.refresh (which_jobs=which_jobs, refresh_all=refresh_all)
+
+    def cleanup (self):
+        for mon in self.monitors:
+            mon.cleanup ()
+            mon.worker.stop ()
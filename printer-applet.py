@@ -33,15 +33,20 @@ http://cyberelk.net/tim/software/system-config-printer/
 svn co http://svn.fedorahosted.org/svn/system-config-printer/trunk
 """
 
+import imp
 import os
-import subprocess
 import sys
 
 import time
 
+# Time the imports below too, when asked.
+import startupprofile
+profile_file = startupprofile.filename_from_argv (sys.argv)
+if profile_file != None:
+    startupprofile.start (profile_file)
+
 from PyQt4.QtCore import *
 from PyQt4.QtGui import QWidget, QKeySequence, QHeaderView, QTreeWidgetItem, QCursor
-from PyQt4 import uic
 from PyKDE4.kdecore import i18n, i18nc, i18np, i18ncp, ki18n, KAboutData, KCmdLineArgs, KCmdLineOptions, KStandardDirs, KLocalizedString, KToolInvocation
 from PyKDE4.kdeui import KApplication, KXmlGuiWindow, KStandardAction, KIcon, KAction, KToggleAction, KNotification, KMenu, KMessageBox, KStatusNotifierItem
 
@@ -55,7 +60,33 @@ def translate(self, prop):
         text = prop.text.encode("UTF-8")
         return i18n(text)
 
-uic.properties.Properties._string = translate
+def generated_ui_classes ():
+    """Returns the window classes generated from the .ui files by
+    pykdeuic4 when installing, or (None, None) if there are none."""
+    try:
+        from ui_printer_applet import Ui_MainWindow
+        from ui_printer_applet_printers import Ui_Form
+        return (Ui_MainWindow, Ui_Form)
+    except ImportError:
+        return (None, None)
+
+def setup_ui (widget, ui_class, filename):
+    """Sets up widget using ui_class, generated from the .ui file
+    filename, or from the .ui file itself if ui_class is None.  Either
+    way the child widgets end up as attributes of widget, as with
+    uic.loadUi."""
+    if ui_class == None:
+        # uic is large, and only needed when running from the source
+        # tree or when nothing was generated.
+        from PyQt4 import uic
+        uic.properties.Properties._string = translate
+        uic.loadUi (unicode (filename), widget)
+        return
+
+    ui = ui_class ()
+    ui.setupUi (widget)
+    for (name, child) in vars (ui).iteritems ():
+        setattr (widget, name, child)
 
 import cups
 
@@ -65,9 +96,19 @@ import dbus.service
 
 from statereason import StateReason
 import monitor
+from records import JobRecord
 import authconn
+import metrics
+import tracing
 from debug import *
 
+log = get_logger ('applet')
+
+# The job attributes shown in the job list, besides the job ID, name
+# and state.
+JOB_VIEW_FIELDS = ['job-originating-user-name', 'job-k-octets',
+                   'time-at-creation']
+
 class PrinterURIIndex:
     def __init__ (self, names=None):
         self.printer = {}
@@ -88,6 +129,16 @@ class PrinterURIIndex:
         for uri in uris:
             self.printer[uri] = printer
 
+    def lookup_cached (self, uri):
+        """Like lookup, but only consults what we already know."""
+        return self.printer[uri]
+
+    def merge (self, other):
+        """Adds what another index has learnt to this one."""
+        self.printer.update (other.printer)
+        if self.names == None:
+            self.names = other.names
+
     def remove_printer (self, printer):
         # Remove references to this printer in the URI map.
         uris = self.printer.keys ()
@@ -171,33 +222,22 @@ class PrintersWindow(QWidget):
         self.applet.on_printer_status_delete_event()
         self.hide()
 
-def collect_printer_state_reasons (connection):
+def collect_printer_state_reasons (printers):
+    """Returns a list of StateReasons for a printer snapshot as
+    provided by monitor.Monitor.get_printer_snapshot."""
     result = []
-    printers = connection.getPrinters ()
-    for name, printer in printers.iteritems ():
-        reasons = printer["printer-state-reasons"]
-        if type (reasons) == str:
-            # Work around a bug that was fixed in pycups-1.9.20.
-            reasons = [reasons]
-        for reason in reasons:
-            if reason == "none":
-                break
-            if (reason.startswith(QLatin1String("moving-to-paused")) or
-                reason.startswith(QLatin1String("paused")) or
-                reason.startswith(QLatin1String("shutdown")) or
-                reason.startswith(QLatin1String("stopping")) or
-                reason.startswith(QLatin1String("stopped-partly"))):
-                continue
-            result.append (StateReason (name, reason))
+    reasons = monitor.collect_printer_state_reasons (printers)
+    for printer_reasons in reasons.itervalues ():
+        result.extend (printer_reasons)
     return result
 
-def worst_printer_state_reason (connection, printer_reasons=None):
-    """Fetches the printer list and checks printer-state-reason for
-    each printer, returning a StateReason for the most severe
+def worst_printer_state_reason (printers, printer_reasons=None):
+    """Checks printer-state-reason for each printer in a printer
+    snapshot, returning a StateReason for the most severe
     printer-state-reason, or None."""
     worst_reason = None
     if printer_reasons == None:
-        printer_reasons = collect_printer_state_reasons (connection)
+        printer_reasons = collect_printer_state_reasons (printers)
     for reason in printer_reasons:
         if worst_reason == None:
             worst_reason = reason
@@ -208,17 +248,183 @@ def worst_printer_state_reason (connection, printer_reasons=None):
     return worst_reason
 
 
+def start_services (applet, servers=None, record=None, replay=None,
+                    replay_speed=1.0):
+    """Starts monitoring for applet, a JobManager or HeadlessWatcher,
+    and publishes its system bus service.  applet.monitor is set to
+    the MultiServerMonitor.  The session bus services come later, from
+    publish_session_services."""
+    dbus.mainloop.qt.DBusQtMainLoop(set_as_default=True)
+
+    try:
+        bus = dbus.SystemBus()
+    except:
+        print >> sys.stderr, "%s: printer-applet failed to connect to system D-Bus"
+        sys.exit (1)
+
+    # Each server's IPP requests are made on its own worker thread.
+    applet.monitor = monitor.MultiServerMonitor (applet, servers=servers,
+                                                 bus=bus, my_jobs=True,
+                                                 specific_dests=None,
+                                                 record=record,
+                                                 replay=replay,
+                                                 replay_speed=replay_speed)
+    applet.connect (QCoreApplication.instance (), SIGNAL ("aboutToQuit()"),
+                    applet.monitor.cleanup)
+
+    applet.new_printer_service = None
+    applet.metrics_service = None
+    applet.query_service = None
+    try:
+        # Only look for cupshelpers here.  cupshelpers.ppds is large,
+        # and only imported once a new printer turns up.
+        imp.find_module ('cupshelpers')
+        applet.new_printer_service = NewPrinterNotification(bus, applet)
+    except ImportError:
+        pass  # cupshelpers not installed, no new printer notification will be shown
+
+def publish_session_services (applet):
+    """Publishes the metrics and query services for applet.  This is
+    done once startup is over, including building the windows with
+    --show, so the bus name appearing marks the end of startup (see
+    benchmarks/startup.py)."""
+    # Metrics and queries are per user, so they go on the session bus.
+    try:
+        session_bus = dbus.SessionBus ()
+        applet.metrics_service = AppletMetrics (session_bus)
+        applet.query_service = AppletQuery (session_bus, applet)
+    except dbus.exceptions.DBusException:
+        debugprint ("Not publishing metrics and queries: no session bus")
+
+class HeadlessWatcher(QObject, monitor.Watcher):
+    """Monitors jobs and printers without any windows or tray icon.
+
+    Printer problems that affect the user's active jobs are still
+    announced with notifications, and jobs and state reasons can be
+    queried over D-Bus (see AppletQuery), but nothing else is shown.
+    This is for kiosk and server sessions where nobody would look at
+    the windows anyway."""
+
+    def __init__ (self, servers=None, record=None, replay=None,
+                  replay_speed=1.0):
+        QObject.__init__ (self)
+        self.jobs = {} # (Monitor, job ID) -> job data
+        self.printer_state_reasons = {} # (Monitor, printer) -> reasons
+        self.notified = set() # of (Monitor, reason tuple)
+        start_services (self, servers, record, replay, replay_speed)
+
+    def job_is_active (self, jobdata):
+        state = jobdata.get ('job-state', cups.IPP_JOB_CANCELED)
+        return state < cups.IPP_JOB_CANCELED
+
+    def annotate (self, jobdata):
+        uri = jobdata.get ('job-printer-uri', '')
+        printer = monitor.printer_name_from_uri (uri)
+        if printer == None:
+            # No (usable) URI, e.g. a placeholder record.
+            printer = uri
+        return jobdata.updated ({'job-printer-name': printer})
+
+    def has_active_job (self, mon, printer):
+        for job, data in self.jobs.iteritems ():
+            if (job[0] is mon and data['job-printer-name'] == printer and
+                self.job_is_active (data)):
+                return True
+        return False
+
+    def notify (self, mon, reason, important_only=True):
+        key = (mon, reason.get_tuple ())
+        if key in self.notified:
+            return
+        if important_only and reason.get_level () < StateReason.WARNING:
+            return
+
+        self.notified.add (key)
+        (title, text) = reason.get_description ()
+        KNotification.event("Other", text, KIcon("printer").pixmap(QSize(22,22)))
+        metrics.count ('ui.notifications')
+
+    def notify_new_printer (self, printer, title, text):
+        KNotification.event(title, text, KIcon("printer").pixmap(QSize(22,22)))
+
+    ## monitor.Watcher interface
+    def current_printers_and_jobs (self, mon, printers, jobs):
+        monitor.Watcher.current_printers_and_jobs (self, mon, printers, jobs)
+        for job in self.jobs.keys ():
+            if job[0] is mon:
+                del self.jobs[job]
+
+        for jobid, jobdata in jobs.iteritems ():
+            self.jobs[(mon, jobid)] = self.annotate (jobdata)
+
+    def jobs_fetched (self, mon):
+        monitor.Watcher.jobs_fetched (self, mon)
+        # The first complete job list marks the end of startup.
+        startupprofile.finish ()
+
+    def job_added (self, mon, jobid, eventname, event, jobdata):
+        monitor.Watcher.job_added (self, mon, jobid, eventname, event, jobdata)
+        jobdata = self.annotate (jobdata)
+        self.jobs[(mon, jobid)] = jobdata
+        if not self.job_is_active (jobdata):
+            return
+
+        printer = jobdata['job-printer-name']
+        for reason in self.printer_state_reasons.get ((mon, printer), []):
+            self.notify (mon, reason)
+
+    def job_event (self, mon, jobid, eventname, event, jobdata):
+        monitor.Watcher.job_event (self, mon, jobid, eventname, event, jobdata)
+        self.jobs[(mon, jobid)] = self.annotate (jobdata)
+
+    def job_removed (self, mon, jobid, eventname, event):
+        monitor.Watcher.job_removed (self, mon, jobid, eventname, event)
+        try:
+            del self.jobs[(mon, jobid)]
+        except KeyError:
+            pass
+
+    def state_reason_added (self, mon, reason):
+        monitor.Watcher.state_reason_added (self, mon, reason)
+        printer = reason.get_printer ()
+        self.printer_state_reasons.setdefault ((mon, printer), []).append (reason)
+        if self.has_active_job (mon, printer):
+            self.notify (mon, reason)
+
+    def state_reason_removed (self, mon, reason):
+        monitor.Watcher.state_reason_removed (self, mon, reason)
+        self.notified.discard ((mon, reason.get_tuple ()))
+        key = (mon, reason.get_printer ())
+        try:
+            self.printer_state_reasons[key].remove (reason)
+            if not self.printer_state_reasons[key]:
+                del self.printer_state_reasons[key]
+        except (KeyError, ValueError):
+            debugprint ("Reason not found")
+
+    def still_connecting (self, mon, reason):
+        monitor.Watcher.still_connecting (self, mon, reason)
+        self.notify (mon, reason, important_only=False)
+
+    def now_connected (self, mon, printer):
+        monitor.Watcher.now_connected (self, mon, printer)
+        for key in list (self.notified):
+            (m, (level, p, r)) = key
+            if m is mon and p == printer and r == "connecting-to-device":
+                self.notified.discard (key)
+
 class JobManager(QObject, monitor.Watcher):
     """our main class creates the systray icon and the dialogues and refreshes the dialogues for new information"""
-    def __init__(self, parent = None):
+    def __init__(self, parent = None, servers=None, record=None,
+                 replay=None, replay_speed=1.0):
         QObject.__init__(self)
 
         self.trayicon = True
         self.suppress_icon_hide = False
-        self.stopped_job_prompts = set() # of job IDs
-        self.printer_state_reasons = {}
+        self.stopped_job_prompts = set() # of (Monitor, job ID)
+        self.printer_state_reasons = {} # (Monitor, printer) -> reasons
         self.num_jobs_when_hidden = 0
-        self.jobs = {}
+        self.jobs = {} # (Monitor, job ID) -> job data
         self.jobiters = {}
         self.will_update_job_creation_times = False # whether timeout is set FIXME now job_creation_times_timer
         self.update_job_creation_times_timer = QTimer(self)
@@ -228,23 +434,63 @@ class JobManager(QObject, monitor.Watcher):
         self.state_reason_notifications = {}
         self.special_status_icon = False
         self.reasoniters = {}
+        self.active_jobs = set()
+        self.printer_uri_index = {} # Monitor -> PrinterURIIndex
+        self.pending_uri_lookups = set() # of (Monitor, URI)
+        # Jobs whose attributes have been fetched for the job list,
+        # or are being fetched.  Each is fetched at most once until
+        # the job changes, as the server may simply not have what we
+        # are missing.
+        self.job_attributes_fetched_for = set() # of (Monitor, job ID)
+        self.show_server_names = servers != None and len (servers) > 1
+        self.status_message = None
+
+        # The windows are only built when they are first wanted.
+        # Until then the jobs and state reasons are just kept in
+        # self.jobs and self.printer_state_reasons.
+        self.mainWindow = None
+        self.printersWindow = None
+
+        self.sysTray = KStatusNotifierItem(self)
+        self.sysTray.setCategory(KStatusNotifierItem.Hardware)
+        self.sysTray.setIconByName("printer")
+        self.connect(self.sysTray, SIGNAL("activateRequested(bool, const QPoint&)"), self.on_tray_activated)
+
+        start_services (self, servers, record, replay, replay_speed)
+
+    def on_tray_activated (self, active, pos):
+        if self.mainWindow == None:
+            self.show_main_window ()
+
+    def show_main_window (self):
+        self.build_ui ()
+        self.mainWindow.show ()
+        self.sysTray.setStatus(KStatusNotifierItem.Active)
 
+    def build_ui (self):
+        """Builds the windows, if that hasn't been done yet, and fills
+        them with what we know so far."""
+        if self.mainWindow != None:
+            return
+
+        start = time.time ()
         #Use local files if in current directory
         if os.path.exists("printer-applet.ui"):
             APPDIR = QDir.currentPath()
+            # Load the .ui files themselves, so changes to them show
+            # up without installing.
+            ui_classes = (None, None)
         else:
-            file =  KStandardDirs.locate("appdata", "printer-applet.ui")
+            file =  KStandardDirs.locate("appdata", "printer-appletui.rc")
             APPDIR = file.left(file.lastIndexOf('/'))
+            ui_classes = generated_ui_classes ()
 
         self.mainWindow = MainWindow()
-        uic.loadUi(unicode(APPDIR + '/' + "printer-applet.ui"), self.mainWindow)
+        setup_ui (self.mainWindow, ui_classes[0], APPDIR + '/' + "printer-applet.ui")
 
         self.printersWindow = PrintersWindow(self)
-        uic.loadUi(unicode(APPDIR + '/' + "printer-applet-printers.ui"), self.printersWindow)
+        setup_ui (self.printersWindow, ui_classes[1], APPDIR + '/' + "printer-applet-printers.ui")
 
-        self.sysTray = KStatusNotifierItem(self.mainWindow)
-        self.sysTray.setCategory(KStatusNotifierItem.Hardware)
-        self.sysTray.setIconByName("printer")
         self.sysTray.setAssociatedWidget(self.mainWindow)
 
         self.mainWindow.treeWidget.setContextMenuPolicy(Qt.CustomContextMenu)
@@ -283,22 +529,14 @@ class JobManager(QObject, monitor.Watcher):
 
         self.mainWindow.createGUI(APPDIR + "/printer-appletui.rc")
 
-        dbus.mainloop.qt.DBusQtMainLoop(set_as_default=True)
-
-        try:
-            bus = dbus.SystemBus()
-        except:
-            print >> sys.stderr, "%s: printer-applet failed to connect to system D-Bus"
-            sys.exit (1)
-
-        self.monitor = monitor.Monitor (self, bus=bus, my_jobs=True,
-                                        specific_dests=None)
-
-        try:
-            import cupshelpers.ppds
-            notification = NewPrinterNotification(bus, self)
-        except ImportError:
-            pass  # cupshelpers not installed, no new printer notification will be shown
+        for job, data in self.jobs.items ():
+            self.add_job_row (job, data)
+        self.update_job_creation_times ()
+        for ((mon, printer), reasons) in self.printer_state_reasons.iteritems ():
+            for reason in reasons:
+                self.add_reason_row (mon, reason)
+        self.show_status_message ()
+        metrics.observe ('ui.build', time.time () - start)
 
     def cleanup (self):
         self.monitor.cleanup ()
@@ -363,10 +601,10 @@ class JobManager(QObject, monitor.Watcher):
 
     def on_show_completed_jobs_activate(self, activated):
         if activated:
-            self.monitor.which_jobs = "all"
+            which_jobs = "all"
         else:
-            self.monitor.which_jobs = "not-completed"
-        self.monitor.refresh()
+            which_jobs = "not-completed"
+        self.monitor.refresh (which_jobs=which_jobs, refresh_all=False)
 
     def on_show_printer_status_activate(self, activated):
         if activated:
@@ -382,11 +620,17 @@ class JobManager(QObject, monitor.Watcher):
     """
 
     def update_job_creation_times(self):
+        if self.mainWindow == None:
+            return False
+
         now = time.time ()
         need_update = False
         for job, data in self.jobs.iteritems():
-            if self.jobs.has_key (job):
+            try:
                 iter = self.jobiters[job]
+            except KeyError:
+                # No row for this job (yet).
+                continue
 
             t = "Unknown"
             if data.has_key ('time-at-creation'):
@@ -423,8 +667,8 @@ class JobManager(QObject, monitor.Watcher):
         # Return code controls whether the timeout will recur.
         return self.will_update_job_creation_times
 
-    def print_error_dialog_response(self, response, jobid):
-        self.stopped_job_prompts.remove (jobid)
+    def print_error_dialog_response(self, response, job):
+        self.stopped_job_prompts.remove (job)
         if response == KMessageBox.No:
             # Diagnose
             if not self.__dict__.has_key ('troubleshooter'):
@@ -433,22 +677,41 @@ class JobManager(QObject, monitor.Watcher):
                 #troubleshooter = troubleshoot.run (self.on_troubleshoot_quit)
                 #self.troubleshooter = troubleshooter
 
+    def printer_label (self, mon, printer):
+        if self.show_server_names:
+            return "%s (%s)" % (printer, mon.get_server_name ())
+        return printer
+
     def add_job (self, job, data):
+        self.jobs[job] = data
+        if self.mainWindow == None:
+            return
+
+        self.add_job_row (job, data)
+        self.update_job_creation_times ()
+
+    def add_job_row (self, job, data):
+        (mon, jobid) = job
         iter = QTreeWidgetItem(self.mainWindow.treeWidget)
-        iter.setText(0, str(job))
+        iter.setText(0, str(jobid))
         iter.setText(1, data.get('job-originating-user-name', i18nc("User who printed is not known", 'Unknown')))
         iter.setText(2, data.get('job-name', i18nc("Print job name is not known", 'Unknown')))
         self.mainWindow.treeWidget.addTopLevelItem(iter)
         self.jobiters[job] = iter
         self.update_job (job, data)
-        self.update_job_creation_times ()
 
     def update_job (self, job, data):
-        iter = self.jobiters[job]
         self.jobs[job] = data
+        if self.mainWindow == None:
+            return
 
+        start = time.time ()
+        span = tracing.begin ('update_job', 'ui')
+        iter = self.jobiters[job]
+
+        (mon, jobid) = job
         printer = data['job-printer-name']
-        iter.setText(3, printer)
+        iter.setText(3, self.printer_label (mon, printer))
 
         size = i18n("Unknown")
         if data.has_key ('job-k-octets'):
@@ -483,6 +746,16 @@ class JobManager(QObject, monitor.Watcher):
             state = i18nc("Job state", "Unknown")
         iter.setText(6, state)
 
+        # The job list gives us everything shown here, but a job first
+        # seen in a notification may be missing some of it.
+        for field in JOB_VIEW_FIELDS:
+            if not data.has_key (field):
+                self.fetch_job_attributes (job)
+                break
+
+        metrics.observe ('ui.update-job', time.time () - start)
+        tracing.end (span)
+
         """FIXME TODO
         # Check whether authentication is required.
         if self.trayicon:
@@ -527,8 +800,8 @@ class JobManager(QObject, monitor.Watcher):
 
         num_jobs = len (self.jobs.keys ())
 
-        debugprint ("num_jobs: %d" % num_jobs)
-        debugprint ("num_jobs_when_hidden: %d" % self.num_jobs_when_hidden)
+        log.debug ("num_jobs: %d", num_jobs)
+        log.debug ("num_jobs_when_hidden: %d", self.num_jobs_when_hidden)
 
         if self.special_status_icon or num_jobs > self.num_jobs_when_hidden:
             self.sysTray.setStatus(KStatusNotifierItem.Active)
@@ -544,8 +817,15 @@ class JobManager(QObject, monitor.Watcher):
         if iter == None:
             return
 
-        self.jobid = int(iter.text(0))
-        job = self.jobs[self.jobid]
+        self.job = None
+        for key, jobiter in self.jobiters.iteritems ():
+            if jobiter is iter:
+                self.job = key
+                break
+        if self.job == None:
+            return
+
+        job = self.jobs[self.job]
         self.cancel.setEnabled (True)
         self.hold.setEnabled (True)
         self.release.setEnabled (True)
@@ -565,67 +845,57 @@ class JobManager(QObject, monitor.Watcher):
     def on_icon_popupmenu(self, icon, button, time):
         self.icon_popupmenu.popup (None, None, None, button, time)
 
-    def on_job_cancel_activate(self):
+    def job_action (self, mon, method, *args):
+        """Performs a job operation such as cancelJob on the server's
+        worker thread, then brings its job list up to date."""
+        mon.worker.submit (self.io_job_action, (mon, method, args),
+                           self.job_action_done)
+
+    def io_job_action (self, mon, method, args):
         try:
-            c = authconn.Connection (self.mainWindow)
-            c.cancelJob (self.jobid)
+            # This runs on the worker thread, where no dialog can be
+            # shown, so never prompt for a password.
+            c = authconn.Connection (None, host=mon.host, port=mon.port)
+            c._set_prompt_allowed (False)
+            getattr (c, method) (*args)
             del c
         except cups.IPPError, (e, m):
-            if (e != cups.IPP_NOT_POSSIBLE and
-                e != cups.IPP_NOT_FOUND):
-                self.show_IPP_Error (e, m)
-            self.monitor.refresh ()
-            return
-        except RuntimeError:
-            return
+            return (mon, method, (e, m))
+        except (RuntimeError, cups.HTTPError):
+            return (mon, method, None)
 
-        self.monitor.refresh ()
+        return (mon, method, ())
 
-    def on_job_hold_activate(self):
-        try:
-            c = authconn.Connection (self.mainWindow)
-            c.setJobHoldUntil (self.jobid, "indefinite")
-            del c
-        except cups.IPPError, (e, m):
-            if (e != cups.IPP_NOT_POSSIBLE and
-                e != cups.IPP_NOT_FOUND):
-                self.show_IPP_Error (e, m)
-            self.monitor.refresh ()
-            return
-        except RuntimeError:
+    def job_action_done (self, result):
+        (mon, method, error) = result
+        if error == None:
+            # Couldn't connect.
             return
 
-        self.monitor.refresh ()
-
-    def on_job_release_activate(self):
-        try:
-            c = authconn.Connection (self.mainWindow)
-            c.setJobHoldUntil (self.jobid, "no-hold")
-            del c
-        except cups.IPPError, (e, m):
-            if (e != cups.IPP_NOT_POSSIBLE and
-                e != cups.IPP_NOT_FOUND):
+        if error:
+            (e, m) = error
+            if (method == 'restartJob' or
+                (e != cups.IPP_NOT_POSSIBLE and
+                 e != cups.IPP_NOT_FOUND)):
                 self.show_IPP_Error (e, m)
-            self.monitor.refresh ()
-            return
-        except RuntimeError:
-            return
 
-        self.monitor.refresh ()
+        mon.refresh (refresh_all=False)
 
-    def on_job_reprint_activate(self):
-        try:
-            c = authconn.Connection (self.mainWindow)
-            c.restartJob (self.jobid)
-            del c
-        except cups.IPPError, (e, m):
-            self.show_IPP_Error (e, m)
-            self.monitor.refresh ()
-            return
-        except RuntimeError:
-            return
+    def on_job_cancel_activate(self):
+        (mon, jobid) = self.job
+        self.job_action (mon, 'cancelJob', jobid)
 
-        self.monitor.refresh ()
+    def on_job_hold_activate(self):
+        (mon, jobid) = self.job
+        self.job_action (mon, 'setJobHoldUntil', jobid, "indefinite")
+
+    def on_job_release_activate(self):
+        (mon, jobid) = self.job
+        self.job_action (mon, 'setJobHoldUntil', jobid, "no-hold")
+
+    def on_job_reprint_activate(self):
+        (mon, jobid) = self.job
+        self.job_action (mon, 'restartJob', jobid)
 
     def on_refresh_activate(self, menuitem):
         self.monitor.refresh ()
@@ -651,22 +921,25 @@ class JobManager(QObject, monitor.Watcher):
         self.sysTray.setToolTip("printer", i18n("Print Status"), tooltip)
 
     def update_status (self, have_jobs=None):
+        start = time.time ()
+        span = tracing.begin ('update_status', 'ui')
         # Found out which printer state reasons apply to our active jobs.
         upset_printers = set()
         for printer, reasons in self.printer_state_reasons.iteritems ():
             if len (reasons) > 0:
                 upset_printers.add (printer)
-        debugprint ("Upset printers: %s" % upset_printers)
+        log.debug ("Upset printers: %s", upset_printers)
 
         my_upset_printers = set()
         if len (upset_printers):
             my_upset_printers = set()
-            for jobid in self.active_jobs:
+            for job in self.active_jobs:
                 # 'job-printer-name' is set by job_added/job_event
-                printer = self.jobs[jobid]['job-printer-name']
+                (mon, jobid) = job
+                printer = (mon, self.jobs[job]['job-printer-name'])
                 if printer in upset_printers:
                     my_upset_printers.add (printer)
-            debugprint ("My upset printers: %s" % my_upset_printers)
+            log.debug ("My upset printers: %s", my_upset_printers)
 
         my_reasons = []
         for printer in my_upset_printers:
@@ -680,21 +953,31 @@ class JobManager(QObject, monitor.Watcher):
                 if reason > worst_reason:
                     worst_reason = reason
             self.worst_reason = worst_reason
-            debugprint ("Worst reason: %s" % worst_reason)
+            log.debug ("Worst reason: %s", worst_reason)
 
         if self.worst_reason != None:
             (title, tooltip) = self.worst_reason.get_description ()
-            self.mainWindow.statusBar().showMessage(tooltip)
-            self.statusbar_set = True
         else:
             tooltip = None
-            if self.statusbar_set:
-                self.mainWindow.statusBar().clearMessage()
-                self.statusbar_set = False
+        self.status_message = tooltip
+        self.show_status_message ()
 
         if self.trayicon:
             self.set_statusicon_visibility ()
             self.set_statusicon_tooltip (tooltip=tooltip)
+        metrics.observe ('ui.update-status', time.time () - start)
+        tracing.end (span)
+
+    def show_status_message (self):
+        if self.mainWindow == None:
+            return
+
+        if self.status_message != None:
+            self.mainWindow.statusBar().showMessage(self.status_message)
+            self.statusbar_set = True
+        elif self.statusbar_set:
+            self.mainWindow.statusBar().clearMessage()
+            self.statusbar_set = False
 
     ## Notifications
     def notify_printer_state_reason_if_important (self, reason):
@@ -708,7 +991,7 @@ class JobManager(QObject, monitor.Watcher):
     def notify_printer_state_reason (self, reason):        
         tuple = reason.get_tuple ()
         if self.state_reason_notifications.has_key (tuple):
-            debugprint ("Already sent notification for %s" % repr (reason))
+            log.debug ("Already sent notification for %r", reason)
             return
 
         """port?
@@ -722,93 +1005,181 @@ class JobManager(QObject, monitor.Watcher):
 
         (title, text) = reason.get_description ()
         KNotification.event("Other", text, KIcon("printer").pixmap(QSize(22,22)))
+        metrics.count ('ui.notifications')
         self.set_statusicon_visibility ()
 
-    ## monitor.Watcher interface
-    def current_printers_and_jobs (self, mon, printers, jobs):
-        self.mainWindow.treeWidget.clear()
-        self.jobs = {}
-        self.jobiters = {}
-        self.printer_uri_index = PrinterURIIndex (names=printers)
-        connection = None
-        for jobid, jobdata in jobs.iteritems ():
-            uri = jobdata.get ('job-printer-uri', '')
+    ## Background lookups
+    def printer_for_uri (self, mon, uri):
+        """Returns the name of the printer on mon's server with this
+        URI.  If we don't know it yet, the name is guessed from the URI
+        for now, and the job rows are updated (and any notifications
+        that were missed are given) once the worker has looked it
+        up."""
+        index = self.printer_uri_index.setdefault (mon, PrinterURIIndex ())
+        try:
+            return index.lookup_cached (uri)
+        except KeyError:
+            pass
+
+        if (mon, uri) not in self.pending_uri_lookups:
+            self.pending_uri_lookups.add ((mon, uri))
+            mon.worker.submit (self.io_lookup_printer, (mon, index.names, uri),
+                               self.printer_looked_up)
+        guess = monitor.printer_name_from_uri (uri)
+        if guess == None:
+            return uri
+        return guess
+
+    def io_lookup_printer (self, mon, names, uri):
+        # The main thread's index is not touched here.  What this
+        # lookup learns goes into an index of its own, which
+        # printer_looked_up merges in.
+        span = tracing.begin ('PrinterURIIndex.lookup', 'applet',
+                              { 'uri': uri })
+        learnt = PrinterURIIndex (names=names)
+        try:
             try:
-                printer = self.printer_uri_index.lookup (uri,
-                                                         connection=connection)
-            except KeyError:
-                printer = uri
-            jobdata['job-printer-name'] = printer
+                printer = learnt.lookup (uri, connection=mon.connection)
+            except (KeyError, RuntimeError, cups.HTTPError):
+                printer = None
+            return (mon, uri, printer, learnt)
+        finally:
+            tracing.end (span)
+
+    def printer_looked_up (self, result):
+        (mon, uri, printer, learnt) = result
+        self.pending_uri_lookups.discard ((mon, uri))
+        index = self.printer_uri_index.setdefault (mon, PrinterURIIndex ())
+        index.merge (learnt)
+        if printer == None:
+            return
+
+        misnamed_active_job = False
+        for job, jobdata in self.jobs.items ():
+            if job[0] is mon and jobdata.get ('job-printer-uri') == uri:
+                if (jobdata.get ('job-printer-name') != printer and
+                    self.job_is_active (jobdata)):
+                    misnamed_active_job = True
+                jobdata = jobdata.updated ({'job-printer-name': printer})
+                self.update_job (job, jobdata)
+
+        self.update_status ()
+
+        # job_added and state_reason_added looked for this printer's
+        # problems under the wrong name; tell the user about them now.
+        if self.trayicon and misnamed_active_job:
+            for reason in self.printer_state_reasons.get ((mon, printer), []):
+                self.notify_printer_state_reason_if_important (reason)
 
-            self.add_job (jobid, jobdata)
+    def fetch_job_attributes (self, job):
+        """Fetches the attributes of one job that is being shown,
+        unless that has already been done since the job last
+        changed."""
+        if job in self.job_attributes_fetched_for:
+            return
 
-            # Fetch complete attributes for these jobs.
-            attrs = None
+        self.job_attributes_fetched_for.add (job)
+        (mon, jobid) = job
+        mon.worker.submit (self.io_fetch_job_attributes, (mon, [jobid]),
+                           self.job_attributes_fetched)
+
+    def io_fetch_job_attributes (self, mon, jobids):
+        result = {}
+        connection = mon.connection
+        for jobid in jobids:
             try:
-                if connection == None:
-                    connection = cups.Connection ()
                 attrs = connection.getJobAttributes (jobid)
-            except RuntimeError:
-                pass
-            except AttributeError:
-                pass
+                result[(mon, jobid)] = JobRecord.core (attrs)
+            except (cups.IPPError, RuntimeError, cups.HTTPError,
+                    AttributeError):
+                result[(mon, jobid)] = None
 
-            if attrs:
-                jobdata.update (attrs)
-                self.update_job (jobid, jobdata)
+        return result
+
+    def job_attributes_fetched (self, result):
+        for job, attrs in result.iteritems ():
+            if attrs == None or not self.jobs.has_key (job):
+                continue
+
+            jobdata = self.jobs[job].updated (attrs)
+            self.update_job (job, jobdata)
+
+    ## monitor.Watcher interface
+    def current_printers_and_jobs (self, mon, printers, jobs):
+        # Forget what we knew about this server's jobs.  Other servers'
+        # jobs are left alone.
+        for job in self.jobs.keys ():
+            if job[0] is not mon:
+                continue
+
+            self.remove_job_row (job)
+            del self.jobs[job]
+            self.active_jobs.discard (job)
+            self.job_attributes_fetched_for.discard (job)
+
+        index = PrinterURIIndex (names=printers)
+        for name, attrs in mon.get_printer_snapshot ().iteritems ():
+            index.update_from_attrs (name, attrs)
+        self.printer_uri_index[mon] = index
 
-        self.jobs = jobs
-        self.active_jobs = set()
         for jobid, jobdata in jobs.iteritems ():
+            uri = jobdata.get ('job-printer-uri', '')
+            printer = self.printer_for_uri (mon, uri)
+            jobdata = jobdata.updated ({'job-printer-name': printer})
+            self.add_job ((mon, jobid), jobdata)
             if self.job_is_active (jobdata):
-                self.active_jobs.add (jobid)
+                self.active_jobs.add ((mon, jobid))
 
         self.update_status ()
 
+    def jobs_fetched (self, mon):
+        monitor.Watcher.jobs_fetched (self, mon)
+        # The first complete job list marks the end of startup.
+        startupprofile.finish ()
+
     def job_added (self, mon, jobid, eventname, event, jobdata):
         monitor.Watcher.job_added (self, mon, jobid, eventname, event, jobdata)
 
         uri = jobdata.get ('job-printer-uri', '')
-        try:
-            printer = self.printer_uri_index.lookup (uri)
-        except KeyError:
-            printer = uri
-        jobdata['job-printer-name'] = printer
+        printer = self.printer_for_uri (mon, uri)
+        jobdata = jobdata.updated ({'job-printer-name': printer})
 
         # We may be showing this job already, perhaps because we are showing
         # completed jobs and one was reprinted.
-        if not self.jobiters.has_key (jobid):
-            self.add_job (jobid, jobdata)
+        job = (mon, jobid)
+        if not self.jobs.has_key (job):
+            self.add_job (job, jobdata)
 
-        self.active_jobs.add (jobid)
+        # Completed jobs turn up here too, e.g. when showing completed
+        # jobs; they don't make the printer ours to worry about.
+        if self.job_is_active (jobdata):
+            self.active_jobs.add (job)
         self.update_status (have_jobs=True)
         if self.trayicon:
             if not self.job_is_active (jobdata):
                 return
 
-            for reason in self.printer_state_reasons.get (printer, []):
-                if not reason.user_notified:
-                    self.notify_printer_state_reason_if_important (reason)
+            for reason in self.printer_state_reasons.get ((mon, printer), []):
+                self.notify_printer_state_reason_if_important (reason)
 
 
     def job_event (self, mon, jobid, eventname, event, jobdata):
         monitor.Watcher.job_event (self, mon, jobid, eventname, event, jobdata)
 
         uri = jobdata.get ('job-printer-uri', '')
-        try:
-            printer = self.printer_uri_index.lookup (uri)
-        except KeyError:
-            printer = uri
-        jobdata['job-printer-name'] = printer
+        printer = self.printer_for_uri (mon, uri)
+        jobdata = jobdata.updated ({'job-printer-name': printer})
 
+        job = (mon, jobid)
+        self.job_attributes_fetched_for.discard (job)
         if self.job_is_active (jobdata):
-            self.active_jobs.add (jobid)
-        elif jobid in self.active_jobs:
-            self.active_jobs.remove (jobid)
+            self.active_jobs.add (job)
+        elif job in self.active_jobs:
+            self.active_jobs.remove (job)
 
         # Look out for stopped jobs.
         if (self.trayicon and eventname == 'job-stopped' and
-            not jobid in self.stopped_job_prompts):
+            not job in self.stopped_job_prompts):
             # Why has the job stopped?  It might be due to a job error
             # of some sort, or it might be that the backend requires
             # authentication.  If the latter, the job will be held not
@@ -816,115 +1187,129 @@ class JobManager(QObject, monitor.Watcher):
             # 'auth-info-required'.  This will be checked for in
             # update_job.
             if jobdata['job-state'] == cups.IPP_JOB_HELD:
-                try:
-                    # Fetch the job-hold-until attribute, as this is
-                    # not provided in the notification attributes.
-                    c = cups.Connection ()
-                    attrs = c.getJobAttributes (jobid)
-                    jobdata.update (attrs)
-                except cups.IPPError:
-                    pass
-                except RuntimeError:
-                    pass
-
-            may_be_problem = True
-            if (jobdata['job-state'] == cups.IPP_JOB_HELD and
-                jobdata['job-hold-until'] == 'auth-info-required'):
-                # Leave this to update_job to deal with.
-                may_be_problem = False
+                # Fetch the job-hold-until attribute, as this is
+                # not provided in the notification attributes.
+                mon.worker.submit (self.io_fetch_job_attributes, (mon, [jobid]),
+                                   lambda result: self.held_job_fetched (job, event, result))
             else:
-                # Other than that, unfortunately the only
-                # clue we get is the notify-text, which is not
-                # translated into our native language.  We'd better
-                # try parsing it.  In CUPS-1.3.6 the possible strings
-                # are:
-                #
-                # "Job stopped due to filter errors; please consult
-                # the error_log file for details."
-                #
-                # "Job stopped due to backend errors; please consult
-                # the error_log file for details."
-                #
-                # "Job held due to backend errors; please consult the
-                # error_log file for details."
-                #
-                # "Authentication is required for job %d."
-                # [This case is handled in the update_job method.]
-                #
-                # "Job stopped due to printer being paused"
-                # [This should be ignored, as the job was doing just
-                # fine until the printer was stopped for other reasons.]
-                notify_text = event['notify-text']
-                document = jobdata['job-name']
-                if notify_text.find ("backend errors") != -1:
-                    message = i18n("There was a problem sending document `%1' "
-                                "(job %2) to the printer.", document, jobid)
-                elif notify_text.find ("filter errors") != -1:
-                    message = i18n("There was a problem processing document `%1' "
-                                "(job %2).", document, jobid)
-                elif notify_text.find ("being paused") != -1:
-                    may_be_problem = False
-                else:
-                    # Give up and use the provided message untranslated.
-                    message = i18n("There was a problem printing document `%1' "
-                                "(job %2): `%3'.", document, jobid,
-                                                      notify_text)
+                self.check_stopped_job (job, event, jobdata)
 
-            if may_be_problem:
+        self.update_job (job, jobdata)
 
-                markup = ('<span weight="bold" size="larger">' +
-                          i18n("Print Error") + '</span><br /><br />' +
-                          message)
-                try:
-                    if event['printer-state'] == cups.IPP_PRINTER_STOPPED:
-                        name = event['printer-name']
-                        markup += ' '
-                        markup += i18n("The printer called `%1' has "
-                                       "been disabled.", name)
-                except KeyError:
-                    pass
+    def held_job_fetched (self, job, event, result):
+        if not self.jobs.has_key (job) or job in self.stopped_job_prompts:
+            return
 
-                self.stopped_job_prompts.add (jobid)
-                result = KMessageBox.sorry(self.mainWindow, markup, i18n("Print Error"))
-                #FIXME GTK version asks a question here but we don't have troubleshooter anyway
-                #self.print_error_dialog_response(result, jobid)
+        self.job_attributes_fetched (result)
+        self.check_stopped_job (job, event, self.jobs[job])
 
-        self.update_job (jobid, jobdata)
+    def check_stopped_job (self, job, event, jobdata):
+        (mon, jobid) = job
+        may_be_problem = True
+        if (jobdata['job-state'] == cups.IPP_JOB_HELD and
+            jobdata.get ('job-hold-until', 'none') == 'auth-info-required'):
+            # Leave this to update_job to deal with.
+            may_be_problem = False
+        else:
+            # Other than that, unfortunately the only
+            # clue we get is the notify-text, which is not
+            # translated into our native language.  We'd better
+            # try parsing it.  In CUPS-1.3.6 the possible strings
+            # are:
+            #
+            # "Job stopped due to filter errors; please consult
+            # the error_log file for details."
+            #
+            # "Job stopped due to backend errors; please consult
+            # the error_log file for details."
+            #
+            # "Job held due to backend errors; please consult the
+            # error_log file for details."
+            #
+            # "Authentication is required for job %d."
+            # [This case is handled in the update_job method.]
+            #
+            # "Job stopped due to printer being paused"
+            # [This should be ignored, as the job was doing just
+            # fine until the printer was stopped for other reasons.]
+            notify_text = event['notify-text']
+            document = jobdata['job-name']
+            if notify_text.find ("backend errors") != -1:
+                message = i18n("There was a problem sending document `%1' "
+                            "(job %2) to the printer.", document, jobid)
+            elif notify_text.find ("filter errors") != -1:
+                message = i18n("There was a problem processing document `%1' "
+                            "(job %2).", document, jobid)
+            elif notify_text.find ("being paused") != -1:
+                may_be_problem = False
+            else:
+                # Give up and use the provided message untranslated.
+                message = i18n("There was a problem printing document `%1' "
+                            "(job %2): `%3'.", document, jobid,
+                                                  notify_text)
+
+        if may_be_problem:
+
+            markup = ('<span weight="bold" size="larger">' +
+                      i18n("Print Error") + '</span><br /><br />' +
+                      message)
+            try:
+                if event['printer-state'] == cups.IPP_PRINTER_STOPPED:
+                    name = event['printer-name']
+                    markup += ' '
+                    markup += i18n("The printer called `%1' has "
+                                   "been disabled.", name)
+            except KeyError:
+                pass
+
+            self.stopped_job_prompts.add (job)
+            result = KMessageBox.sorry(self.mainWindow, markup, i18n("Print Error"))
+            #FIXME GTK version asks a question here but we don't have troubleshooter anyway
+            #self.print_error_dialog_response(result, job)
 
     def job_removed (self, mon, jobid, eventname, event):
         monitor.Watcher.job_removed (self, mon, jobid, eventname, event)
-        if self.jobiters.has_key (jobid):
-
-            index = self.mainWindow.treeWidget.indexOfTopLevelItem(self.jobiters[jobid])
-            self.mainWindow.treeWidget.takeTopLevelItem(index)
-            del self.jobiters[jobid]
-            del self.jobs[jobid]
+        job = (mon, jobid)
+        if self.jobs.has_key (job):
+            self.remove_job_row (job)
+            del self.jobs[job]
+        self.job_attributes_fetched_for.discard (job)
 
-        if jobid in self.active_jobs:
-            self.active_jobs.remove (jobid)
+        if job in self.active_jobs:
+            self.active_jobs.remove (job)
 
         self.update_status ()
 
-    def state_reason_added (self, mon, reason):
-        monitor.Watcher.state_reason_added (self, mon, reason)
+    def remove_job_row (self, job):
+        try:
+            iter = self.jobiters.pop (job)
+        except KeyError:
+            return
 
-        (title, text) = reason.get_description ()
-        printer = reason.get_printer ()
+        index = self.mainWindow.treeWidget.indexOfTopLevelItem(iter)
+        self.mainWindow.treeWidget.takeTopLevelItem(index)
 
+    def add_reason_row (self, mon, reason):
+        (title, text) = reason.get_description ()
         iter = QTreeWidgetItem(self.printersWindow.treeWidget)
-        iter.setText(0, reason.get_printer ())
-        iter.setText(1, printer)
+        iter.setText(0, self.printer_label (mon, reason.get_printer ()))
         iter.setText(1, text)
         self.printersWindow.treeWidget.addTopLevelItem(iter)
-        self.reasoniters[reason.get_tuple ()] = iter
+        self.reasoniters[(mon, reason.get_tuple ())] = iter
+
+    def state_reason_added (self, mon, reason):
+        monitor.Watcher.state_reason_added (self, mon, reason)
+
+        printer = reason.get_printer ()
+        if self.printersWindow != None:
+            self.add_reason_row (mon, reason)
 
         try:
-            l = self.printer_state_reasons[printer]
+            l = self.printer_state_reasons[(mon, printer)]
         except KeyError:
             l = []
-            self.printer_state_reasons[printer] = l
+            self.printer_state_reasons[(mon, printer)] = l
 
-        reason.user_notified = False
         l.append (reason)
         self.update_status ()
 
@@ -933,7 +1318,7 @@ class JobManager(QObject, monitor.Watcher):
 
         # Find out if the user has jobs queued for that printer.
         for job, data in self.jobs.iteritems ():
-            if not self.job_is_active (data):
+            if job[0] is not mon or not self.job_is_active (data):
                 continue
             if data['job-printer-name'] == printer:
                 # Yes!  Notify them of the state reason, if necessary.
@@ -943,16 +1328,17 @@ class JobManager(QObject, monitor.Watcher):
     def state_reason_removed (self, mon, reason):
         monitor.Watcher.state_reason_removed (self, mon, reason)
 
-        try:
-            iter = self.reasoniters[reason.get_tuple ()]
-            index = self.printersWindow.treeWidget.indexOfTopLevelItem(iter)
-            self.printersWindow.treeWidget.takeTopLevelItem(index)
-        except KeyError:
-            debugprint ("Reason iter not found")
+        if self.printersWindow != None:
+            try:
+                iter = self.reasoniters.pop ((mon, reason.get_tuple ()))
+                index = self.printersWindow.treeWidget.indexOfTopLevelItem(iter)
+                self.printersWindow.treeWidget.takeTopLevelItem(index)
+            except KeyError:
+                debugprint ("Reason iter not found")
 
         printer = reason.get_printer ()
         try:
-            reasons = self.printer_state_reasons[printer]
+            reasons = self.printer_state_reasons[(mon, printer)]
         except KeyError:
             debugprint ("Printer not found")
             return
@@ -985,7 +1371,7 @@ class JobManager(QObject, monitor.Watcher):
 
         # Find the connecting-to-device state reason.
         try:
-            reasons = self.printer_state_reasons[printer]
+            reasons = self.printer_state_reasons[(mon, printer)]
             reason = None
             for r in reasons:
                 if r.get_reason () == "connecting-to-device":
@@ -1016,11 +1402,13 @@ class JobManager(QObject, monitor.Watcher):
 
     def printer_event (self, mon, printer, eventname, event):
         monitor.Watcher.printer_event (self, mon, printer, eventname, event)
-        self.printer_uri_index.update_from_attrs (printer, event)
+        index = self.printer_uri_index.setdefault (mon, PrinterURIIndex ())
+        index.update_from_attrs (printer, event)
 
     def printer_removed (self, mon, printer):
         monitor.Watcher.printer_removed (self, mon, printer)
-        self.printer_uri_index.remove_printer (printer)
+        if self.printer_uri_index.has_key (mon):
+            self.printer_uri_index[mon].remove_printer (printer)
 
 ####
 #### NewPrinterNotification DBus server (the 'new' way).
@@ -1096,14 +1484,39 @@ class NewPrinterNotification(dbus.service.Object):
         print "cmd: " + cmd
         """
 
-        c = cups.Connection ()
+        # New printers are only ever set up on this machine.
+        mon = self.jobmanager.monitor.get_local_monitor ()
+        if mon == None:
+            return
+
+        mon.worker.submit (self.io_get_printer, (mon, name),
+                           lambda printer: self.printer_fetched (status, name, printer))
+
+    def io_get_printer (self, mon, name):
+        c = mon.connection
+        r = ['printer-make-and-model']
         try:
-            printer = c.getPrinters ()[name]
-        except KeyError:
+            try:
+                return c.getPrinterAttributes (name, requested_attributes=r)
+            except TypeError:
+                # requested_attributes argument is new in pycups 1.9.40.
+                return c.getPrinterAttributes (name)
+        except (cups.IPPError, RuntimeError, cups.HTTPError):
+            return None
+
+    def printer_fetched (self, status, name, printer):
+        if printer == None:
+            return
+
+        try:
+            from cupshelpers.ppds import ppdMakeModelSplit
+        except ImportError:
+            # cupshelpers was found at startup but cannot be loaded.
+            # As when it is not installed at all, no new printer
+            # notification will be shown.
+            log.warning ("cupshelpers.ppds could not be imported")
             return
-        del c
 
-        from cupshelpers.ppds import ppdMakeModelSplit
         (make, model) = ppdMakeModelSplit (printer['printer-make-and-model'])
         driver = make + " " + model
         if status < self.STATUS_GENERIC_DRIVER:
@@ -1119,6 +1532,67 @@ class NewPrinterNotification(dbus.service.Object):
         self.jobmanager.notify_new_printer (name, title, text)
 
 
+####
+#### Query DBus server.
+####
+QUERY_PATH="/org/kde/PrinterApplet/Query"
+QUERY_IFACE="org.kde.PrinterApplet.Query"
+QUERY_OBJ="org.kde.PrinterApplet"
+class AppletQuery(dbus.service.Object):
+    """Read-only access to the jobs and printer state reasons the
+    applet knows about, with or without its windows.  applet is a
+    JobManager or HeadlessWatcher; both keep jobs keyed by (Monitor,
+    job ID) and lists of StateReasons keyed by (Monitor, printer)."""
+
+    def __init__ (self, bus, applet):
+        self.applet = applet
+        bus_name = dbus.service.BusName (QUERY_OBJ, bus=bus)
+        dbus.service.Object.__init__ (self, bus_name, QUERY_PATH)
+
+    @dbus.service.method(QUERY_IFACE, in_signature='', out_signature='a(sissi)')
+    def GetJobs (self):
+        """Returns (server, job ID, job name, printer, job state) for
+        each job."""
+        result = []
+        for ((mon, jobid), data) in self.applet.jobs.iteritems ():
+            result.append ((mon.get_server_name (), jobid,
+                            data.get ('job-name', ''),
+                            data.get ('job-printer-name') or '',
+                            data.get ('job-state', 0)))
+        return result
+
+    @dbus.service.method(QUERY_IFACE, in_signature='', out_signature='a(sssi)')
+    def GetPrinterStateReasons (self):
+        """Returns (server, printer, reason, level) for each printer
+        problem, level being 1 for a report, 2 a warning and 3 an
+        error."""
+        result = []
+        for ((mon, printer), reasons) in self.applet.printer_state_reasons.iteritems ():
+            for reason in reasons:
+                result.append ((mon.get_server_name (), printer,
+                                reason.get_reason (), reason.get_level ()))
+        return result
+
+####
+#### Metrics DBus server.
+####
+METRICS_PATH="/org/kde/PrinterApplet/Metrics"
+METRICS_IFACE="org.kde.PrinterApplet.Metrics"
+METRICS_OBJ="org.kde.PrinterApplet"
+class AppletMetrics(dbus.service.Object):
+    """Read-only access to the counters and latency histograms in
+    metrics.registry, for monitoring tools."""
+
+    def __init__ (self, bus):
+        bus_name = dbus.service.BusName (METRICS_OBJ, bus=bus)
+        dbus.service.Object.__init__ (self, bus_name, METRICS_PATH)
+
+    @dbus.service.method(METRICS_IFACE, in_signature='', out_signature='a{sd}')
+    def GetMetrics (self):
+        """Returns every metric, flattened as described in metrics.py."""
+        return metrics.snapshot ()
+
+
 if __name__ == "__main__":
     """start the application.  TODO, gtk frontend does clever things here to not start the GUI until it has to"""
     appName     = "printer-applet"
@@ -1139,7 +1613,15 @@ if __name__ == "__main__":
 
     options = KCmdLineOptions()
     options.add("show", ki18n("Show even when nothing printing"))
-
+    options.add("headless", ki18n("Monitor and notify only, without any windows or tray icon"))
+    options.add("server <host[:port]>", ki18n("Monitor this CUPS server instead of the default one (may be given more than once)"))
+    options.add("record <file>", ki18n("Record the CUPS requests made and their answers to this file"))
+    options.add("replay <file>", ki18n("Answer CUPS requests from a recording instead of the server"))
+    options.add("replay-speed <factor>", ki18n("How many times faster than recorded to replay, or 0 for as fast as possible"), "1")
+    options.add("trace <file>", ki18n("Write a Chrome trace of where the time goes to this file"))
+    options.add(startupprofile.OPTION + " <file>", ki18n("Add the time taken by each phase of startup and by each import to this file"))
+
+    startupprofile.phase("kapplication")
     KCmdLineArgs.init(sys.argv, aboutData)
     KCmdLineArgs.addCmdLineOptions(options)
 
@@ -1150,8 +1632,37 @@ if __name__ == "__main__":
     app.setWindowIcon(KIcon("printer"))
     if app.isSessionRestored():
          sys.exit(1)
-    applet = JobManager()
-    if args.isSet("show"):
-        applet.mainWindow.show()
-        applet.sysTray.setStatus(KStatusNotifierItem.Active)
-    sys.exit(app.exec_())
+    servers = None
+    if args.isSet("server"):
+        servers = [str(server) for server in args.getOptionList("server")]
+    record = None
+    if args.isSet("record"):
+        record = str(args.getOption("record"))
+    replay = None
+    if args.isSet("replay"):
+        replay = str(args.getOption("replay"))
+    try:
+        replay_speed = float(str(args.getOption("replay-speed")))
+    except ValueError:
+        replay_speed = 1.0
+    if args.isSet("trace"):
+        tracing.start(str(args.getOption("trace")))
+    startupprofile.phase("applet")
+    if args.isSet("headless"):
+        applet = HeadlessWatcher(servers=servers, record=record,
+                                 replay=replay, replay_speed=replay_speed)
+    else:
+        applet = JobManager(servers=servers, record=record, replay=replay,
+                            replay_speed=replay_speed)
+    if args.isSet("show") and not args.isSet("headless"):
+        startupprofile.phase("show")
+        applet.show_main_window()
+    publish_session_services(applet)
+    if startupprofile.is_enabled():
+        # Waiting for the first job list to arrive; but don't lose the
+        # profile if it never does.
+        startupprofile.phase("first-jobs")
+        app.connect(app, SIGNAL("aboutToQuit()"), startupprofile.finish)
+    status = app.exec_()
+    tracing.stop()
+    sys.exit(status)
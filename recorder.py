@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Recording of the IPP requests a Monitor makes, and replaying them
+later without a CUPS server.
+
+A recording is a gzip-compressed stream of pickles.  First comes a
+header dict, then one tuple per request:
+
+  (start, duration, method, args, kwds, outcome)
+
+start and duration are in seconds, with start measured from the
+beginning of the recording.  outcome is ('result', value) or
+describes the exception raised: ('ipp', status, message),
+('http', status), ('runtime', message), ('type', message),
+('attribute', message) or, for any other exception, ('error',
+repr of the exception)."""
+
+import cPickle
+import gzip
+import time
+
+import cups
+from debug import *
+
+RECORDING_VERSION = 1
+
+class RecordingConnection:
+    """Wraps a connection (normally a monitor.MonitorConnection) and
+    writes every request made through it, with its timing and
+    outcome, to a file."""
+
+    def __init__ (self, connection, filename, host=None, port=None):
+        self._connection = connection
+        self._file = gzip.open (filename, "wb")
+        self._start = time.time ()
+        self._dump ({ 'version': RECORDING_VERSION,
+                      'host': host,
+                      'port': port,
+                      'time': self._start })
+        debugprint ("Recording IPP requests to %s" % filename)
+
+    def __getattr__ (self, fname):
+        if fname[0] == '_':
+            raise AttributeError, fname
+        return lambda *args, **kwds: self._call (fname, *args, **kwds)
+
+    def _dump (self, obj):
+        cPickle.dump (obj, self._file, cPickle.HIGHEST_PROTOCOL)
+        # Keep what we have so far if the applet dies.
+        self._file.flush ()
+
+    def _call (self, fname, *args, **kwds):
+        start = time.time ()
+        outcome = None
+        try:
+            try:
+                result = getattr (self._connection, fname) (*args, **kwds)
+                outcome = ('result', result)
+                return result
+            except cups.IPPError, (e, m):
+                outcome = ('ipp', e, m)
+                raise
+            except cups.HTTPError, (s,):
+                outcome = ('http', s)
+                raise
+            except RuntimeError, e:
+                outcome = ('runtime', str (e))
+                raise
+            except TypeError, e:
+                outcome = ('type', str (e))
+                raise
+            except AttributeError, e:
+                outcome = ('attribute', str (e))
+                raise
+            except Exception, e:
+                # Not something pycups is expected to raise; replaying
+                # it can only give back a description.
+                outcome = ('error', repr (e))
+                raise
+        finally:
+            end = time.time ()
+            # Nothing is recorded for KeyboardInterrupt and the like.
+            if self._file != None and outcome != None:
+                self._dump ((start - self._start, end - start,
+                             fname, args, kwds, outcome))
+
+    def close (self):
+        if self._file != None:
+            self._file.close ()
+            self._file = None
+        self._connection.close ()
+
+def load_recording (filename):
+    """Returns the header and the list of requests in a recording."""
+    f = gzip.open (filename, "rb")
+    try:
+        header = cPickle.load (f)
+        requests = []
+        while True:
+            try:
+                requests.append (cPickle.load (f))
+            except EOFError:
+                break
+    finally:
+        f.close ()
+
+    if header.get ('version') != RECORDING_VERSION:
+        raise ValueError, "%s: unknown recording version" % filename
+
+    return (header, requests)
+
+class ReplayConnection:
+    """Answers a Monitor's requests from a recording instead of a CUPS
+    server.
+
+    Each method gets the recorded answers for that method in the order
+    they were recorded, whatever arguments it is called with.  When a
+    method's answers run out, getNotifications returns no events and
+    anything else fails as though the server had gone away.
+
+    speed is how many times faster than recorded to go; 0 means as
+    fast as possible.  Waiting is done in the calling thread, which is
+    the Monitor's worker thread when it has one.  The notify-get-interval
+    in each batch of notifications is rewritten so that the Monitor
+    polls when the next recorded batch is due."""
+
+    def __init__ (self, filename, speed=1.0):
+        (self.header, requests) = load_recording (filename)
+        self.speed = speed
+        self.answers = {}
+        for (start, duration, fname, args, kwds, outcome) in requests:
+            answers = self.answers.setdefault (fname, [])
+            answers.append ((start + duration, outcome))
+
+        self.replay_start = None
+        self.recording_start = None
+        self.get_interval = 60
+        debugprint ("Replaying %d IPP requests from %s" %
+                    (len (requests), filename))
+
+    def __getattr__ (self, fname):
+        if fname[0] == '_':
+            raise AttributeError, fname
+        return lambda *args, **kwds: self._call (fname, *args, **kwds)
+
+    def _wait_until (self, when):
+        if self.speed <= 0:
+            return
+
+        now = time.time ()
+        if self.replay_start == None:
+            # Line up the first request with the start of the replay.
+            self.replay_start = now
+            self.recording_start = when
+            return
+
+        delay = ((when - self.recording_start) / self.speed -
+                 (now - self.replay_start))
+        if delay > 0:
+            time.sleep (delay)
+
+    def _next_interval (self, fname):
+        """Seconds until the next recorded call of fname is due."""
+        answers = self.answers.get (fname)
+        if self.speed <= 0 or not answers:
+            return 0
+
+        (when, outcome) = answers[0]
+        now = time.time ()
+        due = ((when - self.recording_start) / self.speed -
+               (now - self.replay_start))
+        return max (0, due)
+
+    def _call (self, fname, *args, **kwds):
+        answers = self.answers.get (fname)
+        if not answers:
+            if fname == 'getNotifications':
+                return { 'events': [],
+                         'notify-get-interval': self.get_interval }
+            raise RuntimeError, "no more recorded %s answers" % fname
+
+        (when, outcome) = answers.pop (0)
+        self._wait_until (when)
+        kind = outcome[0]
+        if kind == 'ipp':
+            raise cups.IPPError (outcome[1], outcome[2])
+        elif kind == 'http':
+            raise cups.HTTPError (outcome[1])
+        elif kind == 'runtime':
+            raise RuntimeError, outcome[1]
+        elif kind == 'type':
+            raise TypeError, outcome[1]
+        elif kind == 'attribute':
+            raise AttributeError, outcome[1]
+        elif kind == 'error':
+            raise Exception, outcome[1]
+
+        result = outcome[1]
+        if fname == 'getNotifications':
+            self.get_interval = result.get ('notify-get-interval',
+                                            self.get_interval)
+            result = result.copy ()
+            result['notify-get-interval'] = self._next_interval (fname)
+
+        return result
+
+    def close (self):
+        pass
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Compact read-only records for the job and printer attributes we
+keep around."""
+
+# The attributes the applet actually looks at get a slot each.
+JOB_FIELDS = ['job-id', 'job-state', 'job-name',
+              'job-originating-user-name', 'job-printer-uri',
+              'job-printer-name', 'job-k-octets', 'time-at-creation',
+              'job-hold-until', 'job-preserved']
+
+PRINTER_FIELDS = ['printer-name', 'printer-state', 'printer-state-reasons',
+                  'printer-uri-supported', 'printer-more-info']
+
+def _slot_names (fields):
+    return [field.replace ('-', '_') for field in fields]
+
+class Record(object):
+    """A read-only set of IPP attributes that looks like a dict.
+
+    The attributes named in FIELDS are stored in __slots__, which
+    costs far less than a dict entry each.  Any other attribute
+    goes into a dict that is only created when the first one turns up.
+
+    Records are shared rather than copied.  Use updated() to get a
+    changed record, or copy() for a plain dict you can modify."""
+
+    __slots__ = ['_extra']
+    FIELDS = []
+    _SLOTS = {}
+
+    def __init__ (self, attrs=None):
+        self._extra = None
+        if attrs != None:
+            self._set_all (attrs)
+
+    @classmethod
+    def core (cls, attrs):
+        """Returns a record of just the FIELDS attributes in attrs.
+        Anything else CUPS sent is dropped."""
+        record = cls ()
+        slots = cls._SLOTS
+        for name in cls.FIELDS:
+            try:
+                object.__setattr__ (record, slots[name], attrs[name])
+            except KeyError:
+                pass
+        return record
+
+    def _set_all (self, attrs):
+        slots = self._SLOTS
+        for name, value in attrs.iteritems ():
+            try:
+                object.__setattr__ (self, slots[name], value)
+            except KeyError:
+                if self._extra == None:
+                    self._extra = {}
+                self._extra[name] = value
+
+    def __setattr__ (self, name, value):
+        if name != '_extra':
+            raise TypeError, "records are read-only"
+        object.__setattr__ (self, name, value)
+
+    def __getitem__ (self, name):
+        try:
+            slot = self._SLOTS[name]
+        except KeyError:
+            if self._extra == None:
+                raise KeyError, name
+            return self._extra[name]
+
+        try:
+            return getattr (self, slot)
+        except AttributeError:
+            raise KeyError, name
+
+    def get (self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def has_key (self, name):
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    __contains__ = has_key
+
+    def iteritems (self):
+        for name in self.FIELDS:
+            try:
+                yield (name, getattr (self, self._SLOTS[name]))
+            except AttributeError:
+                pass
+
+        if self._extra != None:
+            for item in self._extra.iteritems ():
+                yield item
+
+    def items (self):
+        return list (self.iteritems ())
+
+    def keys (self):
+        return [name for (name, value) in self.iteritems ()]
+
+    def __iter__ (self):
+        return iter (self.keys ())
+
+    def __len__ (self):
+        return len (self.keys ())
+
+    def copy (self):
+        return dict (self.iteritems ())
+
+    def updated (self, attrs):
+        """Returns a new record with attrs added or replaced."""
+        record = self.__class__ ()
+        for name in self.FIELDS:
+            slot = self._SLOTS[name]
+            try:
+                object.__setattr__ (record, slot, getattr (self, slot))
+            except AttributeError:
+                pass
+
+        if self._extra != None:
+            record._extra = self._extra.copy ()
+        record._set_all (attrs)
+        return record
+
+    def __eq__ (self, other):
+        if isinstance (other, Record):
+            other = other.copy ()
+        return self.copy () == other
+
+    def __ne__ (self, other):
+        return not self == other
+
+    def __repr__ (self):
+        return "<%s %s>" % (self.__class__.__name__, repr (self.copy ()))
+
+class JobRecord(Record):
+    FIELDS = JOB_FIELDS
+    __slots__ = _slot_names (FIELDS)
+    _SLOTS = dict (zip (FIELDS, __slots__))
+
+class PrinterRecord(Record):
+    FIELDS = PRINTER_FIELDS
+    __slots__ = _slot_names (FIELDS)
+    _SLOTS = dict (zip (FIELDS, __slots__))
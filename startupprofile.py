@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Where the time goes while the applet starts, for --profile-startup.
+
+start () is called before the applet's heavy imports.  From then on,
+each module first imported on the main thread has its import time
+recorded: its own time, not counting the modules it imports in turn,
+which are recorded separately.  phase () divides startup into named
+phases, each lasting until the next one starts, and finish () ends
+the last of them and appends one line to the profile file.
+
+The line is a JSON object holding when the applet started, the wall
+time of each phase and of the whole startup, and the import times,
+all in seconds.  Each launch adds a line, so the file shows how
+startup time changes from one version to the next."""
+
+import __builtin__
+import json
+import sys
+import thread
+import time
+
+OPTION = "profile-startup"
+
+class StartupProfile:
+    def __init__ (self, filename):
+        self.filename = filename
+        self.started = time.time ()
+        self.phases = [] # of (name, seconds)
+        self.phase_name = None
+        self.phase_start = self.started
+        self.imports = {} # module name -> seconds
+        self.nested = [] # time spent in nested imports, per level
+        self.main_thread = thread.get_ident ()
+        self.original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def _import (self, name, globals=None, locals=None, fromlist=None,
+                 level=-1):
+        if thread.get_ident () != self.main_thread:
+            return self.original_import (name, globals, locals, fromlist,
+                                         level)
+
+        before = len (sys.modules)
+        self.nested.append (0.0)
+        start = time.time ()
+        try:
+            return self.original_import (name, globals, locals, fromlist,
+                                         level)
+        finally:
+            elapsed = time.time () - start
+            nested = self.nested.pop ()
+            if self.nested:
+                self.nested[-1] += elapsed
+            if len (sys.modules) != before:
+                # Something was actually loaded.
+                self.imports[name] = (self.imports.get (name, 0.0) +
+                                      elapsed - nested)
+
+    def phase (self, name):
+        now = time.time ()
+        if self.phase_name != None:
+            self.phases.append ((self.phase_name, now - self.phase_start))
+        self.phase_name = name
+        self.phase_start = now
+
+    def finish (self):
+        self.phase (None)
+        __builtin__.__import__ = self.original_import
+        profile = { 'started': self.started,
+                    'total': self.phase_start - self.started,
+                    'phases': self.phases,
+                    'import-total': sum (self.imports.values ()),
+                    'imports': self.imports }
+        try:
+            f = file (self.filename, "a")
+            try:
+                f.write (json.dumps (profile) + "\n")
+            finally:
+                f.close ()
+        except IOError, e:
+            print >> sys.stderr, ("printer-applet: cannot write startup "
+                                  "profile: %s" % e)
+
+_profile = None
+
+def filename_from_argv (argv):
+    """Returns the file given with --profile-startup in argv, or
+    None.  This is needed before the command line is parsed
+    properly, as the imports have to be timed from the start."""
+    for i in range (1, len (argv)):
+        arg = argv[i].lstrip ('-')
+        if arg == OPTION and i + 1 < len (argv):
+            return argv[i + 1]
+        if arg.startswith (OPTION + "="):
+            return arg[len (OPTION) + 1:]
+    return None
+
+def start (filename):
+    """Starts profiling, beginning with a phase called 'imports'."""
+    global _profile
+    _profile = StartupProfile (filename)
+    _profile.phase ('imports')
+
+def is_enabled ():
+    return _profile != None
+
+def phase (name):
+    """Ends the current phase and starts another."""
+    if _profile != None:
+        _profile.phase (name)
+
+def finish ():
+    """Ends the last phase and writes the profile.  Only the first
+    call does anything."""
+    global _profile
+    if _profile != None:
+        _profile.finish ()
+        _profile = None
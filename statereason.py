@@ -25,11 +25,19 @@
 ##
 #############################################################################
 
+import weakref
+
 from PyKDE4.kdecore import i18n, ki18n
 
-class StateReason:
+class StateReason(object):
     """Holds problem information for a printer and can be ordered for priority 
-    by comparing with another instance"""
+    by comparing with another instance.
+
+    StateReasons are interned: asking for the same printer and reason
+    string again gives back the same object, for as long as that
+    object is in use anywhere.  They are read-only, and
+    their level, canonical reason and tuple are worked out once, when
+    the reason is first seen."""
     REPORT=1
     WARNING=2
     ERROR=3
@@ -40,39 +48,53 @@ class StateReason:
         ERROR: "dialog-error"
         }
 
-    def __init__(self, printer, reason):
-        self.printer = printer
-        self.reason = reason
-        self.level = None
-        self.canonical_reason = None
+    __slots__ = ['printer', 'reason', 'level', 'canonical_reason', 'tuple',
+                 '__weakref__']
+
+    # (printer, reason string) -> StateReason.  Reasons nobody holds
+    # any more, e.g. for deleted printers, drop out by themselves.
+    _interned = weakref.WeakValueDictionary ()
+
+    def __new__(cls, printer, reason):
+        key = (printer, reason)
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+
+        if (reason.endswith ("-report") or
+            reason == "connecting-to-device"):
+            level = cls.REPORT
+            canonical_reason = reason
+        elif reason.endswith ("-warning"):
+            level = cls.WARNING
+            canonical_reason = reason[:-8]
+        else:
+            level = cls.ERROR
+            canonical_reason = reason
+            if reason.endswith ("-error"):
+                canonical_reason = reason[:-6]
+
+        self = object.__new__ (cls)
+        init = object.__setattr__
+        init (self, 'printer', printer)
+        init (self, 'reason', reason)
+        init (self, 'level', level)
+        init (self, 'canonical_reason', canonical_reason)
+        init (self, 'tuple', (level, printer, canonical_reason))
+        cls._interned[key] = self
+        return self
+
+    def __setattr__ (self, name, value):
+        raise TypeError, "StateReasons are read-only"
 
     def get_printer (self):
         return self.printer
 
     def get_level (self):
-        if self.level != None:
-            return self.level
-
-        if (self.reason.endswith ("-report") or
-            self.reason == "connecting-to-device"):
-            self.level = self.REPORT
-        elif self.reason.endswith ("-warning"):
-            self.level = self.WARNING
-        else:
-            self.level = self.ERROR
         return self.level
 
     def get_reason (self):
-        if self.canonical_reason:
-            return self.canonical_reason
-
-        level = self.get_level ()
-        reason = self.reason
-        if level == self.WARNING and reason.endswith ("-warning"):
-            reason = reason[:-8]
-        elif level == self.ERROR and reason.endswith ("-error"):
-            reason = reason[:-6]
-        self.canonical_reason = reason
         return self.canonical_reason
 
     def get_description (self):
@@ -114,13 +136,21 @@ class StateReason:
         return (title, text)
 
     def get_tuple (self):
-        return (self.get_level (), self.get_printer (), self.get_reason ())
+        return self.tuple
 
     def __cmp__(self, other):
-        if other == None:
+        if other is self:
+            return 0
+        if other is None:
             return 1
-        if other.get_level () != self.get_level ():
-            return cmp (self.get_level (), other.get_level ())
-        if other.get_printer () != self.get_printer ():
-            return cmp (other.get_printer (), self.get_printer ())
-        return cmp (other.get_reason (), self.get_reason ())
+        if other.level != self.level:
+            return cmp (self.level, other.level)
+        if other.printer != self.printer:
+            return cmp (other.printer, self.printer)
+        return cmp (other.canonical_reason, self.canonical_reason)
+
+    def __hash__ (self):
+        return hash (self.tuple)
+
+    def __repr__ (self):
+        return "<StateReason %s: %s>" % (self.printer, self.reason)
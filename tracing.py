@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+##
+## Copyright 2026 The printer-applet contributors
+## Authors: see the git history of this file
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of
+## the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Opt-in span tracing, written in Chrome's trace event format.
+
+Nothing is traced until start () is called.  After that, each span
+(from begin () to end ()) becomes one complete ("X") event in the
+trace file: a JSON array that is never closed, which chrome://tracing
+accepts as it is, so the file can be loaded while the applet is
+still running.
+
+Spans on the same thread nest by time, so the IPP requests made on a
+Monitor's worker thread show up on their own row, and a
+get_notifications or refresh cycle on the main thread contains the
+watcher callbacks it led to.
+
+When the file reaches max_bytes it is renamed with .1 appended (and
+any older ones shifted along, up to backups of them) and a new file
+is started."""
+
+import json
+import os
+import thread
+import threading
+import time
+
+MAX_BYTES = 16 * 1024 * 1024
+BACKUPS = 3
+
+class Tracer:
+    def __init__ (self, filename, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pid = os.getpid ()
+        self.lock = threading.Lock ()
+        self.file = None
+        self._open ()
+
+    def _open (self):
+        self.file = file (self.filename, "w")
+        self.file.write ("[\n")
+        self.named_threads = set()
+
+    def _rotate (self):
+        self.file.close ()
+        for i in range (self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.filename, i)
+            if os.path.exists (older):
+                os.rename (older, "%s.%d" % (self.filename, i + 1))
+        if self.backups > 0:
+            os.rename (self.filename, self.filename + ".1")
+        self._open ()
+
+    def _write (self, event):
+        self.file.write (json.dumps (event) + ",\n")
+
+    def emit (self, name, cat, start, end, tid, args):
+        event = { 'name': name,
+                  'cat': cat,
+                  'ph': 'X',
+                  'ts': int (start * 1000000),
+                  'dur': int ((end - start) * 1000000),
+                  'pid': self.pid,
+                  'tid': tid }
+        if args:
+            event['args'] = args
+
+        self.lock.acquire ()
+        try:
+            if self.file == None:
+                return
+
+            if tid not in self.named_threads:
+                # Label each thread's row with the thread's name.
+                self.named_threads.add (tid)
+                thread_name = threading.currentThread ().getName ()
+                self._write ({ 'name': 'thread_name',
+                               'ph': 'M',
+                               'pid': self.pid,
+                               'tid': tid,
+                               'args': { 'name': thread_name } })
+
+            self._write (event)
+            if cat == 'cycle':
+                # A whole cycle is there to be looked at.
+                self.file.flush ()
+            if self.file.tell () >= self.max_bytes:
+                self._rotate ()
+        finally:
+            self.lock.release ()
+
+    def close (self):
+        self.lock.acquire ()
+        try:
+            if self.file != None:
+                self.file.close ()
+                self.file = None
+        finally:
+            self.lock.release ()
+
+_tracer = None
+
+def start (filename, max_bytes=MAX_BYTES, backups=BACKUPS):
+    """Starts writing spans to filename."""
+    global _tracer
+    stop ()
+    _tracer = Tracer (filename, max_bytes, backups)
+
+def stop ():
+    global _tracer
+    if _tracer != None:
+        _tracer.close ()
+        _tracer = None
+
+def is_enabled ():
+    return _tracer != None
+
+def begin (name, cat, args=None):
+    """Starts a span and returns it, to be passed to end ().  When
+    tracing is off this returns None, which end () ignores."""
+    if _tracer == None:
+        return None
+    return (name, cat, time.time (), thread.get_ident (), args)
+
+def end (span, args=None):
+    """Finishes a span.  args, a dict, is added to any given to
+    begin ()."""
+    if span == None or _tracer == None:
+        return
+
+    (name, cat, start, tid, begin_args) = span
+    if begin_args and args:
+        begin_args = begin_args.copy ()
+        begin_args.update (args)
+    elif args:
+        begin_args = args
+    _tracer.emit (name, cat, start, time.time (), tid, begin_args)